@@ -1,8 +1,67 @@
+import os
+import re
 import sys
-from utils import strtol, find_label
+import json
+from itertools import accumulate
+from utils import CompileError
+
+# The tokens of a line of assembly code: the label, the mnemonic and the operands, with
+# imm(reg) split into imm and reg, and the comment that ends the line
+TOKEN = re.compile(r"#.*|[^\s,()#]+")
+
+class Relocation():
+    """ Reference to a symbol the assembler could not resolve
+
+    Attributes:
+        offset (int): The offset of the instruction to patch within the object.
+        kind (str): "branch" for B-type or "jal" for J-type immediates.
+        symbol (str): The name of the referenced symbol.
+
+    """
+
+    def __init__(self, offset: int, kind: str, symbol: str) -> None:
+        self.offset = offset
+        self.kind = kind
+        self.symbol = symbol
+
+class ObjectFile():
+    """ Relocatable machine code of one translation unit
+
+    Attributes:
+        code (bytes): The machine code, with zero immediates at the relocations.
+        symbols (dict[str, int]): The offsets of the global labels defined in the object.
+        relocations (list[Relocation]): The references to symbols of other objects.
+        key (str): The content address of the source the object was built from.
+
+    """
+
+    def __init__(self, code: bytes, symbols: dict[str, int], relocations: list[Relocation], key: str = "") -> None:
+        self.code = code
+        self.symbols = symbols
+        self.relocations = relocations
+        self.key = key
+
+    def save(self, file_path: str) -> None:
+        with open(file_path, "w") as f:
+            json.dump({"key": self.key, "code": self.code.hex(), "symbols": self.symbols,
+                       "relocations": [[r.offset, r.kind, r.symbol] for r in self.relocations]}, f)
+
+    def executable(self) -> bytes:
+        """ The machine code of an object that references no other object """
+
+        if len(self.relocations) > 0:
+            raise CompileError(f"Undefined symbol: {self.relocations[0].symbol}")
+        return self.code
+
+    @staticmethod
+    def load(file_path: str) -> "ObjectFile":
+        with open(file_path, "r") as f:
+            obj = json.load(f)
+        return ObjectFile(bytes.fromhex(obj["code"]), obj["symbols"],
+                          [Relocation(*r) for r in obj["relocations"]], obj["key"])
 
 class Assembler():
-    REGISTER_MAP = {"zero": "00000", "ra": "00001", "sp": "00010", "gp": "00011", "tp": "000100", "t0": "00101",
+    REGISTER_MAP = {"zero": "00000", "ra": "00001", "sp": "00010", "gp": "00011", "tp": "00100", "t0": "00101",
                     "t1": "00110", "t2": "00111", "fp": "01000", "s0": "01000", "s1": "01001", "a0": "01010",
                     "a1": "01011", "a2": "01100", "a3": "01101", "a4": "01110", "a5": "01111", "a6": "10000",
                     "a7": "10001", "s2": "10010", "s3": "10011", "s4": "10100", "s5": "10101", "s6": "10110",
@@ -13,8 +72,11 @@ class Assembler():
         pass
 
     @staticmethod
-    def _imm_to_bin(imm: str, width) -> str:
+    def _imm_to_bin(imm: str, width, unsigned: bool = False) -> str:
         imm = int(imm)
+        upper = 1 << width if unsigned else 1 << (width - 1)
+        if not -(1 << (width - 1)) <= imm < upper:
+            raise CompileError(f"Immediate out of range for {width} bits: {imm}")
         if imm < 0:
             imm = (1 << width) + imm
         return f"{imm:0{width}b}"
@@ -47,12 +109,12 @@ class Assembler():
     
     @staticmethod
     def _b_instruction(rs1: str, rs2: str, imm: str, funct3: str) -> str:
-        imm = Assembler._imm_to_bin(imm, 12)
-        return f"{imm[0]}{imm[2:8]}{Assembler.REGISTER_MAP[rs2]}{Assembler.REGISTER_MAP[rs1]}{funct3}{imm[8:]}{imm[1]}1100011"
+        imm = Assembler._imm_to_bin(imm, 13)   # imm[12:1], bit 0 is always zero
+        return f"{imm[0]}{imm[2:8]}{Assembler.REGISTER_MAP[rs2]}{Assembler.REGISTER_MAP[rs1]}{funct3}{imm[8:12]}{imm[1]}1100011"
     
     @staticmethod
     def _u_instruction(opcode: str, rd: str, imm: str) -> str:
-        imm = Assembler._imm_to_bin(imm, 20)
+        imm = Assembler._imm_to_bin(imm, 20, unsigned=True)
         return f"{imm}{Assembler.REGISTER_MAP[rd]}{opcode}"
     
     @staticmethod
@@ -65,130 +127,252 @@ class Assembler():
     
     @staticmethod
     def _j_instruction(rd: str, imm: str) -> str:
-        imm = Assembler._imm_to_bin(imm, 20)
-        return f"{imm[0]}{imm[10:]}{imm[9]}{imm[1:9]}{Assembler.REGISTER_MAP[rd]}1101111"
+        imm = Assembler._imm_to_bin(imm, 21)   # imm[20:1], bit 0 is always zero
+        return f"{imm[0]}{imm[10:20]}{imm[9]}{imm[1:9]}{Assembler.REGISTER_MAP[rd]}1101111"
     
     @staticmethod
     def _jal_instruction(rd: str, imm: str) -> str:
         return Assembler._j_instruction(rd, imm)
 
     @staticmethod
-    def _calc_offset(label: str, lines: list[str], i: int) -> str:
-        if label.isdigit():
-            offset = label
+    def _li_parts(imm: int) -> tuple:
+        """ Split a 32-bit constant into the immediates of lui and addi
+
+        Returns:
+            tuple: The lui immediate (None if addi alone suffices) and the addi immediate (None if lui alone suffices).
+
+        """
+
+        if not -(1 << 31) <= imm < (1 << 32):
+            raise CompileError(f"Immediate out of range for 32 bits: {imm}")
+        if imm >= (1 << 31):
+            imm -= 1 << 32
+
+        if -2048 <= imm < 2048:
+            return None, imm
+
+        # addi sign-extends its immediate, so round the upper part to compensate
+        hi = ((imm + 0x800) >> 12) & 0xfffff
+        lo = imm - (((imm + 0x800) >> 12) << 12)
+        return hi, (lo if lo != 0 else None)
+
+    @staticmethod
+    def _li_instruction(rd: str, imm: str) -> str:
+        # addi, lui or lui + addi, whichever is shortest
+        hi, lo = Assembler._li_parts(int(imm))
+        bin = ""
+        if hi is not None:
+            bin += Assembler._lui_instruction(rd, str(hi))
+        if lo is not None:
+            bin += Assembler._arithmetic_instruction(rd, "zero" if hi is None else rd, str(lo), "000")
+        return bin
+
+    @staticmethod
+    def _long_branch_instruction(ops: list[str], addr: int, target) -> str:
+        # bnez rs, +8 over a j, which reaches ±1 MiB instead of ±4 KiB
+        bin = Assembler._b_instruction(ops[0], "zero", "8", "001")
+        return bin + Assembler._j_instruction("zero", target(ops[1], addr + 4, "jal"))
+
+    @staticmethod
+    def _indirect_jump_instruction(ops: list[str]) -> str:
+        # jalr rs, or jalr rd, rs[, imm]
+        if len(ops) == 1:
+            return Assembler._jalr_instruction("ra", ops[0], "0")
+        return Assembler._jalr_instruction(ops[0], ops[1], ops[2] if len(ops) > 2 else "0")
+
+    # Encoder of each mnemonic, given the operands, the address of the instruction and
+    # the function resolving a label to an offset (see _assemble). The address of lw and
+    # sw comes as two operands, the offset and the base register.
+    ENCODERS = {
+        "addi": lambda ops, addr, target: Assembler._arithmetic_instruction(ops[0], ops[1], ops[2], "000"),
+        "ori": lambda ops, addr, target: Assembler._arithmetic_instruction(ops[0], ops[1], ops[2], "110"),
+        "add": lambda ops, addr, target: Assembler._r_instruction(ops[0], ops[1], ops[2], "000", "0000000"),
+        "sub": lambda ops, addr, target: Assembler._r_instruction(ops[0], ops[1], ops[2], "000", "0100000"),
+        "slt": lambda ops, addr, target: Assembler._r_instruction(ops[0], ops[1], ops[2], "010", "0000000"),
+        "sltu": lambda ops, addr, target: Assembler._r_instruction(ops[0], ops[1], ops[2], "011", "0000000"),
+        "xor": lambda ops, addr, target: Assembler._r_instruction(ops[0], ops[1], ops[2], "100", "0000000"),
+        "or": lambda ops, addr, target: Assembler._r_instruction(ops[0], ops[1], ops[2], "110", "0000000"),
+        "lui": lambda ops, addr, target: Assembler._lui_instruction(ops[0], ops[1]),
+        "lw": lambda ops, addr, target: Assembler._load_instruction(ops[0], ops[2], ops[1], "010"),
+        "sw": lambda ops, addr, target: Assembler._s_instruction(ops[0], ops[2], ops[1], "010"),
+
+        # M-extension
+        "mul": lambda ops, addr, target: Assembler._r_instruction(ops[0], ops[1], ops[2], "000", "0000001"),
+        "div": lambda ops, addr, target: Assembler._r_instruction(ops[0], ops[1], ops[2], "100", "0000001"),
+
+        # pseudo instructions
+        "li": lambda ops, addr, target: Assembler._li_instruction(ops[0], ops[1]),
+        "mv": lambda ops, addr, target: Assembler._arithmetic_instruction(ops[0], ops[1], "0", "000"),
+        "seqz": lambda ops, addr, target: Assembler._arithmetic_instruction(ops[0], ops[1], "1", "011"),     # sltiu rd, rs, 1
+        "snez": lambda ops, addr, target: Assembler._r_instruction(ops[0], "zero", ops[1], "011", "0000000"),  # sltu rd, zero, rs
+
+        "beqz": lambda ops, addr, target: Assembler._b_instruction("zero", ops[0], target(ops[1], addr, "branch"), "000"),
+        "j": lambda ops, addr, target: Assembler._j_instruction("zero", target(ops[0], addr, "jal")),
+        "jal": lambda ops, addr, target: Assembler._jal_instruction(ops[0] if len(ops) > 1 else "ra", target(ops[-1], addr, "jal")),
+        "jalr": lambda ops, addr, target: Assembler._indirect_jump_instruction(ops),
+        "ret": lambda ops, addr, target: Assembler._jalr_instruction("zero", "ra", "0"),
+    }
+
+    # Mnemonics whose encoding depends on the address of the instruction
+    JUMPS = ("beqz", "j", "jal")
+
+    @staticmethod
+    def _calc_offset(label: str, labels: dict[str, int], addr: int, relocations: list, kind: str):
+        if label.lstrip("-").isdigit():
+            return label
         
-        else:
-            idx = find_label(label, lines)
-            offset = str((idx - i)*4)
+        if label in labels:
+            return str(labels[label] - addr)
         
-        return offset
+        # Defined in another object, the linker patches the offset in
+        relocations.append(Relocation(addr, kind, label))
+        return "0"
 
-    def assemble(self, file_path: str) -> None:
-        with open("out.bin", "bw") as out:
-            pass
-        
-        f = open(file_path, "r")
-        lines = f.readlines()
-        lines = [line.split() for line in lines]
-        lines = [line for line in lines if len(line) > 0]
-        for i in range(len(lines)):
-            for j in range(len(lines[i])):
-                lines[i][j] = lines[i][j].replace(",", "")
-
-        for i, toks in enumerate(lines):
-            bin = ""
+    @staticmethod
+    def _parse(lines: list[str], instructions: list, labels: list) -> None:
+        """ Tokenize lines of assembly code
+
+        Args:
+            lines (list[str]): The lines.
+            instructions (list): The instructions parsed so far, to append the (mnemonic, operands) of the lines to.
+            labels (list): The labels parsed so far, to append the (name, index of the next instruction) of the lines to.
+
+        """
+
+        for line in lines:
+            toks = TOKEN.findall(line)
+            if len(toks) > 0 and toks[-1][0] == "#":
+                toks.pop()
             if len(toks) == 0:
                 continue
-            if toks[0] == "main:":
-                continue
-            
-            elif toks[0] == "addi":
-                bin = Assembler._arithmetic_instruction(toks[1], toks[2], toks[3], "000")
-            
-            elif toks[0] == "ori":
-                bin = Assembler._arithmetic_instruction(toks[1], toks[2], toks[3], "110")
-            
-            elif toks[0] == "add":
-                bin = Assembler._r_instruction(toks[1], toks[2], toks[3], "000", "0000000")
-            
-            elif toks[0] == "sub":
-                bin = Assembler._r_instruction(toks[1], toks[2], toks[3], "000", "0100000")
-            
-            elif toks[0] == "slt":
-                bin = Assembler._r_instruction(toks[1], toks[2], toks[3], "010", "0000000")
-            
-            elif toks[0] == "sltu":
-                bin = Assembler._r_instruction(toks[1], toks[2], toks[3], "011", "0000000")
-            
-            elif toks[0] == "xor":
-                bin = Assembler._r_instruction(toks[1], toks[2], toks[3], "100", "0000000")
-            
-            elif toks[0] == "or":
-                bin = Assembler._r_instruction(toks[1], toks[2], toks[3], "110", "0000000")
-            
-            elif toks[0] == "lui":
-                bin = Assembler._lui_instruction(toks[1], toks[2])
-            
-            elif toks[0] == "lw":
-                imm, val_len = strtol(toks[2])
-                rest = toks[2][val_len:]
-                rs1 = rest.replace("(", "").replace(")", "")
-                bin = Assembler._load_instruction(toks[1], rs1, imm, "010")
-            
-            elif toks[0] == "sw":
-                imm, val_len = strtol(toks[2])
-                rest = toks[2][val_len:]
-                rs1 = rest.replace("(", "").replace(")", "")
-                bin = Assembler._s_instruction(toks[1], rs1, imm, "010")
-            
-            # M-extension
-            elif toks[0] == "mul":
-                bin = Assembler._r_instruction(toks[1], toks[2], toks[3], "000", "0000001")
-            
-            elif toks[0] == "div":
-                bin = Assembler._r_instruction(toks[1], toks[2], toks[3], "100", "0000001")
-            
-            # pseudo instructions
-            elif toks[0] == "li":
-                bin = Assembler._arithmetic_instruction(toks[1], "zero", toks[2], "000")
-            
-            elif toks[0] == "mv":
-                bin = Assembler._arithmetic_instruction(toks[1], toks[2], "0", "000")
-
-            elif toks[0] == "seqz":
-                bin = Assembler._arithmetic_instruction(toks[1], "zero", "1", "011")
-            
-            elif toks[0] == "snez":
-                bin = Assembler._r_instruction(toks[1], "zero", toks[2], "010", "0000000")
-            
-            elif toks[0] == "beqz":
-                offset = Assembler._calc_offset(toks[2], lines, i)
-                bin = Assembler._b_instruction("zero", toks[1], offset, "000")
-            
-            elif toks[0] == "j":
-                offset = Assembler._calc_offset(toks[1], lines, i)
-                bin = Assembler._j_instruction("zero", offset)
-
-            elif toks[0] == "ret":
+
+            if toks[0][-1] == ":":
+                labels.append((toks[0][:-1], len(instructions)))
+                del toks[0]
+                if len(toks) == 0:
+                    continue
+
+            # The offset of lw and sw may be left out, as in lw t0, (sp)
+            if toks[0] in ("lw", "sw") and len(toks) == 3 and "(" in line:
+                toks.insert(2, "0")
+
+            if toks[0] == "li" and len(toks) == 3 and not toks[2].lstrip("-").isdigit():
+                raise CompileError(f"Invalid immediate: {toks[2]}")
+            instructions.append((toks[0], toks[1:]))
+
+    def assemble(self, file_path: str, out_path: str = "out.bin") -> None:
+        with open(file_path, "r") as f:
+            binary = self.assemble_source(f.read())
+
+        with open(out_path, "bw") as out:
+            out.write(binary)
+
+    def assemble_source(self, src: str) -> bytes:
+        return self.assemble_object(src).executable()
+
+    def assemble_object(self, src: str) -> "ObjectFile":
+        instructions = []
+        labels = []
+        Assembler._parse(src.splitlines(), instructions, labels)
+        return self._assemble(instructions, labels)
+
+    def assemble_records(self, records: list) -> "ObjectFile":
+        """ Assemble the output of the compiler without going through text
+
+        Args:
+            records (list): Lines of assembly code as str, and instructions as objects with a
+                mnemonic and operands like scheduler.Instruction, the address of lw and sw split
+                into the offset and the base register.
+
+        Returns:
+            ObjectFile: The relocatable object.
+
+        """
+
+        instructions = []
+        labels = []
+        lines = []
+        for record in records:
+            if isinstance(record, str):
+                lines.append(record)
                 continue
+            Assembler._parse(lines, instructions, labels)
+            lines = []
+            instructions.append((record.mnemonic, record.operands))
+        Assembler._parse(lines, instructions, labels)
+        return self._assemble(instructions, labels)
+
+    def _assemble(self, instructions: list, labels: list) -> "ObjectFile":
+        positions = {}
+        for name, index in labels:
+            if name in positions:
+                raise CompileError(f"Duplicate label: {name}")
+            positions[name] = index
+
+        sizes = [1] * len(instructions)
+        branches = []
+        for i, (mnemonic, operands) in enumerate(instructions):
+            if mnemonic == "li" and len(operands) == 2:
+                sizes[i] = sum(part is not None for part in Assembler._li_parts(int(operands[1])))
+            elif mnemonic == "beqz" and len(operands) == 2 and operands[1] in positions:
+                branches.append(i)
+
+        # Assign an address to every instruction. A beqz whose target is out of the reach
+        # of a branch becomes bnez over a j, which moves the instructions after it, so
+        # repeat until no more branch has to be expanded.
+        long_branches = set()
+        while True:
+            addrs = list(accumulate((4 * size for size in sizes), initial=0))
+            expanded = False
+            for i in branches:
+                if i not in long_branches and not -4096 <= addrs[positions[instructions[i][1][1]]] - addrs[i] < 4096:
+                    long_branches.add(i)
+                    sizes[i] = 2
+                    expanded = True
 
-            elif toks[0] == "#":
+            if not expanded:
+                break
+
+        addresses = {name: addrs[index] for name, index in positions.items()}
+        out = bytearray()
+        relocations = []
+
+        def target(label: str, addr: int, kind: str) -> str:
+            return Assembler._calc_offset(label, addresses, addr, relocations, kind)
+
+        # Compiled code repeats a few instructions over and over, so the encoding of
+        # those without a label operand is looked up rather than computed again
+        encoded = {}
+        for i, (mnemonic, operands) in enumerate(instructions):
+            key = None if mnemonic in Assembler.JUMPS else (mnemonic, *operands)
+            code = encoded.get(key)
+            if code is not None:
+                out += code
                 continue
 
-            else:
-                if toks[0][-1] == ":":
-                    continue
+            encoder = Assembler.ENCODERS.get(mnemonic)
+            if encoder is None:
+                raise CompileError(f"Unknown instruction: {mnemonic}")
+            if i in long_branches:
+                encoder = Assembler._long_branch_instruction
 
-                else:
-                    print(f"Unknown instruction: {toks[0]}", file=sys.stderr)
-                    sys.exit(1)
+            try:
+                bin = encoder(operands, addrs[i], target)
+            except IndexError:
+                raise CompileError(f"Missing operand: {mnemonic} {', '.join(operands)}")
+            except KeyError as e:
+                raise CompileError(f"Unknown register: {e.args[0]}")
+            except ValueError:
+                raise CompileError(f"Invalid immediate: {mnemonic} {', '.join(operands)}")
 
-            if len(bin) > 0:
-                out = open("out.bin", "ba")
-                out.write(int(bin, 2).to_bytes(len(bin) // 8, byteorder="big"))
-                out.close()
-                
+            code = int(bin, 2).to_bytes(len(bin) // 8, byteorder="big")
+            if key is not None:
+                encoded[key] = code
+            out += code
 
+        # Local labels (.L*) never leave the object
+        symbols = {label: addr for label, addr in addresses.items() if not label.startswith(".L")}
+        return ObjectFile(bytes(out), symbols, relocations)
 
 
 if __name__ == "__main__":
@@ -197,5 +381,20 @@ if __name__ == "__main__":
         print("The given number of arguments is invalid.", file=sys.stderr)
         sys.exit(1)
 
-    linker = Assembler()
-    linker.assemble(args[1])
\ No newline at end of file
+    try:
+        if os.environ.get("TC_CACHE_DIR"):
+            from cache import CompilationCache
+            cache = CompilationCache(os.environ["TC_CACHE_DIR"])
+            with open(args[1], "r") as f:
+                binary = cache.assemble(f.read())
+            with open("out.bin", "bw") as out:
+                out.write(binary)
+            print(f"cache: {cache.stats}", file=sys.stderr)
+
+        else:
+            linker = Assembler()
+            linker.assemble(args[1])
+
+    except CompileError as e:
+        print(e, file=sys.stderr)
+        sys.exit(1)
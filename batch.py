@@ -0,0 +1,188 @@
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from cache import CacheStats, CompilationCache, run_pipeline
+from utils import CompileError
+
+_worker_cache = None
+
+
+def available_cores() -> int:
+    if hasattr(os, "sched_getaffinity"):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+
+def collect_sources(target: str) -> tuple[str, list[str]]:
+    """ Collect the C files to compile
+
+    Args:
+        target (str): A directory to search for .c files, or a manifest listing one path per line.
+
+    Returns:
+        tuple[str, list[str]]: The root the outputs are laid out relative to, and the source paths.
+
+    """
+
+    if os.path.isdir(target):
+        sources = []
+        for root, _, files in os.walk(target):
+            for name in files:
+                if name.endswith(".c"):
+                    sources.append(os.path.join(root, name))
+        return target, sorted(sources)
+
+    root = os.path.dirname(target)
+    sources = []
+    with open(target, "r") as f:
+        for line in f:
+            line = line.strip()
+            if len(line) == 0 or line.startswith("#"):
+                continue
+            sources.append(os.path.join(root, line))
+    return root, sources
+
+
+class BatchResult():
+    """ Outcome of compiling one file
+
+    Attributes:
+        path (str): The source path.
+        ok (bool): Whether every stage of the pipeline succeeded.
+        error (str): The error message when the compilation failed.
+        elapsed (float): The wall-clock time spent on the file in seconds.
+        size (int): The size of the machine code in bytes.
+        cache (CacheStats): The lookups of the file in the compilation cache, or None without a cache.
+
+    """
+
+    def __init__(self, path: str, ok: bool, error: str = "", elapsed: float = 0.0, size: int = 0,
+                 cache: CacheStats = None) -> None:
+        self.path = path
+        self.ok = ok
+        self.error = error
+        self.elapsed = elapsed
+        self.size = size
+        self.cache = cache
+
+
+def _init_worker(cache_dir: str) -> None:
+    global _worker_cache
+    _worker_cache = CompilationCache(cache_dir) if cache_dir else None
+
+
+def _compile_one(job: tuple[str, str, str, bool]) -> BatchResult:
+    """ Run the pipeline on one file, isolating its failure from the rest of the batch
+
+    Args:
+        job (tuple[str, str, str, bool]): The source path, the output root, the input root and the verbosity.
+
+    Returns:
+        BatchResult: The outcome of the compilation.
+
+    """
+
+    path, out_root, in_root, verbose = job
+    start = time.perf_counter()
+    stats = CacheStats() + _worker_cache.stats if _worker_cache is not None else None
+
+    def result(ok: bool, error: str = "", size: int = 0) -> BatchResult:
+        # The statistics of the worker add up over its files, keep the share of this one
+        cache = _worker_cache.stats - stats if _worker_cache is not None else None
+        return BatchResult(path, ok, error, time.perf_counter() - start, size, cache)
+
+    try:
+        with open(path, "r") as f:
+            src = f.read()
+
+        if _worker_cache is not None:
+            artifacts = _worker_cache.compile(src, verbose)
+        else:
+            artifacts = run_pipeline(src, verbose)
+
+        # A unit without main gets no startup code, its image would start in its first function
+        if "main" not in artifacts.obj.symbols:
+            raise CompileError("No main function: link the unit with linker.py instead.")
+
+        stem = os.path.splitext(os.path.relpath(path, in_root))[0]
+        out_path = os.path.join(out_root, stem)
+        os.makedirs(os.path.dirname(out_path) or ".", exist_ok=True)
+        with open(f"{out_path}.s", "w") as f:
+            f.write(artifacts.asm)
+        binary = artifacts.obj.executable()
+        with open(f"{out_path}.bin", "bw") as f:
+            f.write(binary)
+
+    except CompileError as e:
+        return result(False, str(e))
+
+    except Exception as e:     # Keep going on internal errors (e.g. RecursionError) as well
+        return result(False, f"{type(e).__name__}: {e}")
+
+    return result(True, size=len(binary))
+
+
+class BatchCompiler():
+    """ Compile many C files across a process pool
+
+    Attributes:
+        jobs (int): The number of worker processes.
+        out_dir (str): The directory to write the outputs to, or None to write them next to the sources.
+        verbose (bool): Whether to annotate the assembly code with comments.
+        cache_dir (str): The directory of the shared compilation cache, or None.
+
+    """
+
+    def __init__(self, jobs: int = None, out_dir: str = None, verbose: bool = False, cache_dir: str = None) -> None:
+        self.jobs = jobs or available_cores()
+        self.out_dir = out_dir
+        self.verbose = verbose
+        self.cache_dir = cache_dir
+
+    def run(self, in_root: str, sources: list[str]) -> list[BatchResult]:
+        out_root = self.out_dir if self.out_dir else in_root
+        jobs = [(path, out_root, in_root, self.verbose) for path in sources]
+
+        if self.jobs == 1 or len(jobs) <= 1:
+            _init_worker(self.cache_dir)
+            return [_compile_one(job) for job in jobs]
+
+        # Hand out work in chunks so that small programs do not drown in IPC overhead
+        chunksize = max(1, len(jobs) // (self.jobs * 8))
+        with ProcessPoolExecutor(max_workers=self.jobs, initializer=_init_worker, initargs=(self.cache_dir,)) as pool:
+            return list(pool.map(_compile_one, jobs, chunksize=chunksize))
+
+    @staticmethod
+    def report(results: list[BatchResult], elapsed: float) -> str:
+        failed = [r for r in results if not r.ok]
+        cpu_time = sum(r.elapsed for r in results)
+
+        lines = []
+        for r in failed:
+            lines.append(f"FAILED {r.path}: {r.error}")
+        lines.append(f"{len(results) - len(failed)} succeeded, {len(failed)} failed, {len(results)} total")
+        lines.append(f"wall time: {elapsed:.2f}s, compile time: {cpu_time:.2f}s, "
+                     f"output: {sum(r.size for r in results)} bytes")
+
+        cached = [r.cache for r in results if r.cache is not None]
+        if len(cached) > 0:
+            lines.append(f"cache: {sum(cached, CacheStats())}")
+        return "\n".join(lines)
+
+
+if __name__ == "__main__":
+    args = sys.argv
+    if len(args) not in (2, 3):
+        print("The given number of arguments is invalid.", file=sys.stderr)
+        sys.exit(1)
+
+    in_root, sources = collect_sources(args[1])
+    batch = BatchCompiler(out_dir=args[2] if len(args) == 3 else None, cache_dir=os.environ.get("TC_CACHE_DIR"))
+
+    start = time.perf_counter()
+    results = batch.run(in_root, sources)
+    print(BatchCompiler.report(results, time.perf_counter() - start))
+
+    if not all(r.ok for r in results):
+        sys.exit(1)
@@ -0,0 +1,376 @@
+import contextlib
+import functools
+import hashlib
+import json
+import os
+import pickle
+import sys
+from collections import OrderedDict
+from tokenizer import Tokenizer
+from syntax_tree import Parser
+from compiler import Compiler
+from scheduler import default_machine, render
+from assembler import Assembler
+
+try:
+    import fcntl
+except ImportError:     # Windows, where processes sharing a cache directory are not serialized
+    fcntl = None
+
+COMPILER_VERSION = "0.1.0"
+
+# Modules whose source takes part in the cache key, so that editing the
+# toolchain invalidates every entry produced by the previous revision.
+TOOLCHAIN_MODULES = ["utils.py", "tokenizer.py", "syntax_tree.py", "inliner.py", "licm.py", "unroller.py", "cse.py", "scheduler.py", "compiler.py",
+                     "assembler.py", "cache.py"]
+
+
+@functools.lru_cache(maxsize=None)
+def toolchain_fingerprint() -> str:
+    """ Hash the compiler version together with the toolchain sources
+
+    Returns:
+        str: The hex digest identifying this revision of the toolchain.
+
+    """
+
+    h = hashlib.sha256(COMPILER_VERSION.encode())
+    base = os.path.dirname(os.path.abspath(__file__))
+    for name in TOOLCHAIN_MODULES:
+        with open(os.path.join(base, name), "rb") as f:
+            h.update(f.read())
+    return h.hexdigest()
+
+
+def cache_key(src: str, stage: str, options: dict = None) -> str:
+    """ Compute the content address of a compilation
+
+    Args:
+        src (str): The source text (C code or assembly code).
+        stage (str): The pipeline stage the source enters at ("c" or "asm").
+        options (dict): The options the pipeline is run with.
+
+    Returns:
+        str: The hex digest used as the cache key.
+
+    """
+
+    h = hashlib.sha256()
+    h.update(toolchain_fingerprint().encode())
+    h.update(stage.encode())
+    h.update(json.dumps(options or {}, sort_keys=True).encode())
+    h.update(src.encode())
+    return h.hexdigest()
+
+
+class Artifacts():
+    """ Products of one run of the pipeline
+
+    Attributes:
+        tokens (list[Token]): The token stream produced by the tokenizer.
+        parser (Parser): The parser holding the syntax tree and the local variables as parsed, before optimization.
+        asm (str): The generated assembly code.
+        obj (ObjectFile): The assembled machine code, which may still reference functions of other units.
+
+    """
+
+    def __init__(self, tokens = None, parser = None, asm = None, obj = None) -> None:
+        self.tokens = tokens
+        self.parser = parser
+        self.asm = asm
+        self.obj = obj
+
+
+def run_pipeline(src: str, verbose: bool = False) -> Artifacts:
+    """ Tokenize, parse, compile and assemble the given C code
+
+    Args:
+        src (str): The C code.
+        verbose (bool): Whether to annotate the assembly code with comments.
+
+    Returns:
+        Artifacts: The products of every stage of the pipeline.
+
+    """
+
+    tokenizer = Tokenizer()
+    tokenizer.tokenize(src)
+    tokens = tokenizer.tokens
+    parser = Parser(tokenizer)
+    parser.parse()
+
+    # The optimization passes rewrite the syntax tree in place, so keep a copy of it as parsed
+    snapshot = pickle.loads(pickle.dumps(parser))
+    records = Compiler(parser).generate_records(verbose)
+    asm = render(records)
+    obj = Assembler().assemble_records(records)
+
+    return Artifacts(tokens, snapshot, asm, obj)
+
+
+class CacheStats():
+    FIELDS = ("memory_hits", "disk_hits", "misses", "stores", "evictions")
+
+    def __init__(self, memory_hits: int = 0, disk_hits: int = 0, misses: int = 0, stores: int = 0, evictions: int = 0) -> None:
+        self.memory_hits = memory_hits
+        self.disk_hits = disk_hits
+        self.misses = misses
+        self.stores = stores
+        self.evictions = evictions
+
+    def __add__(self, other: "CacheStats") -> "CacheStats":
+        return CacheStats(*(getattr(self, name) + getattr(other, name) for name in CacheStats.FIELDS))
+
+    def __sub__(self, other: "CacheStats") -> "CacheStats":
+        return CacheStats(*(getattr(self, name) - getattr(other, name) for name in CacheStats.FIELDS))
+
+    @property
+    def hits(self) -> int:
+        return self.memory_hits + self.disk_hits
+
+    def __str__(self) -> str:
+        total = self.hits + self.misses
+        rate = self.hits / total * 100 if total else 0.0
+        return (f"hits: {self.hits} (memory: {self.memory_hits}, disk: {self.disk_hits}), "
+                f"misses: {self.misses}, hit rate: {rate:.1f}%, "
+                f"stores: {self.stores}, evictions: {self.evictions}")
+
+
+class MemoryCache():
+    """ In-memory LRU layer bounded by the number of entries """
+
+    def __init__(self, max_entries: int = 256) -> None:
+        self.max_entries = max_entries
+        self.entries: OrderedDict[str, Artifacts] = OrderedDict()
+
+    def get(self, key: str):
+        if key not in self.entries:
+            return None
+        self.entries.move_to_end(key)
+        return self.entries[key]
+
+    def put(self, key: str, artifacts: Artifacts) -> int:
+        self.entries[key] = artifacts
+        self.entries.move_to_end(key)
+
+        evicted = 0
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+            evicted += 1
+        return evicted
+
+
+class DiskCache():
+    """ On-disk LRU layer bounded by the total size of the stored entries
+
+    Entries are pickled into ``<cache_dir>/<key[:2]>/<key>.pkl``. The modification
+    time of an entry is refreshed on every hit and serves as its recency.
+
+    The limit applies to the directory, which may be shared by several processes. Their
+    total is kept in ``<cache_dir>/size`` and updated on every store under an exclusive
+    lock on that file, so that storing does not cost a walk over the whole cache. Once
+    the total crosses the limit, the directory is scanned and the least recently used
+    entries are evicted until the total is back at 90% of the limit, so that the next
+    walk is only due after many more stores.
+
+    Attributes:
+        entries (OrderedDict[str, int]): The size of every entry as of the last scan, from the least to the most recently used.
+        total (int): The total size of the entries as of the last scan.
+
+    """
+
+    def __init__(self, cache_dir: str, max_bytes: int = 64 * 1024 * 1024) -> None:
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        os.makedirs(cache_dir, exist_ok=True)
+
+        # Kept open, opening files is a good part of the cost of a store
+        self._size_fd = os.open(os.path.join(cache_dir, "size"), os.O_RDWR | os.O_CREAT)
+        self.entries: OrderedDict[str, int] = OrderedDict()
+        self.total = 0
+        with self._lock():
+            self._scan()
+            self._write_total(self.total)
+
+    def __del__(self) -> None:
+        if hasattr(self, "_size_fd"):
+            os.close(self._size_fd)
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.cache_dir, key[:2], f"{key}.pkl")
+
+    @contextlib.contextmanager
+    def _lock(self):
+        if fcntl is not None:
+            fcntl.flock(self._size_fd, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            if fcntl is not None:
+                fcntl.flock(self._size_fd, fcntl.LOCK_UN)
+
+    def _read_total(self) -> int:
+        os.lseek(self._size_fd, 0, os.SEEK_SET)
+        try:
+            return int(os.read(self._size_fd, 32))
+        except ValueError:
+            return self.max_bytes + 1   # Unknown, so scan the directory to find out
+
+    def _write_total(self, total: int) -> None:
+        data = str(total).encode()
+        os.lseek(self._size_fd, 0, os.SEEK_SET)
+        os.write(self._size_fd, data)
+        os.ftruncate(self._size_fd, len(data))
+
+    def _scan(self) -> None:
+        found = []
+        for root, _, files in os.walk(self.cache_dir):
+            for name in files:
+                if not name.endswith(".pkl"):
+                    continue
+                path = os.path.join(root, name)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue    # Evicted by another process in the meantime
+                found.append((st.st_mtime, path, st.st_size))
+
+        self.entries = OrderedDict((path, size) for _, path, size in sorted(found))
+        self.total = sum(self.entries.values())
+
+    def get(self, key: str):
+        path = self._path(key)
+        try:
+            with open(path, "rb") as f:
+                artifacts = pickle.load(f)
+            os.utime(path)
+        except (OSError, pickle.UnpicklingError, EOFError, AttributeError):
+            # Another process may have evicted the entry in the meantime
+            return None
+        return artifacts
+
+    def put(self, key: str, artifacts: Artifacts) -> int:
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        # Write to a temporary file first so that concurrent readers never see a partial entry
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "wb") as f:
+            pickle.dump(artifacts, f)
+            size = f.tell()
+
+        with self._lock():
+            try:
+                size -= os.path.getsize(path)
+            except OSError:
+                pass
+            os.replace(tmp_path, path)
+
+            total = self._read_total() + size
+            evicted = self._evict() if total > self.max_bytes else 0
+            self._write_total(self.total if total > self.max_bytes else total)
+        return evicted
+
+    def _evict(self) -> int:
+        # The other processes may have stored entries of their own, so the directory is the reference
+        self._scan()
+        evicted = 0
+        while self.total > self.max_bytes * 0.9 and len(self.entries) > 0:
+            path, size = self.entries.popitem(last=False)
+            self.total -= size
+            try:
+                os.remove(path)
+            except OSError:
+                continue    # Already gone
+            evicted += 1
+        return evicted
+
+
+class CompilationCache():
+    """ Content-addressed cache of the tokenizer, parser, compiler and assembler products
+
+    Lookups go to the in-memory layer first and fall back to the on-disk layer,
+    which is only used when a cache directory is given.
+
+    Attributes:
+        memory (MemoryCache): The in-memory layer.
+        disk (DiskCache): The on-disk layer, or None.
+        stats (CacheStats): The hit/miss statistics.
+
+    """
+
+    def __init__(self, cache_dir: str = None, max_bytes: int = 64 * 1024 * 1024, max_entries: int = 256) -> None:
+        self.memory = MemoryCache(max_entries)
+        self.disk = DiskCache(cache_dir, max_bytes) if cache_dir else None
+        self.stats = CacheStats()
+
+    def lookup(self, key: str):
+        artifacts = self.memory.get(key)
+        if artifacts is not None:
+            self.stats.memory_hits += 1
+            return artifacts
+
+        if self.disk:
+            artifacts = self.disk.get(key)
+            if artifacts is not None:
+                self.stats.disk_hits += 1
+                self.memory.put(key, artifacts)
+                return artifacts
+
+        self.stats.misses += 1
+        return None
+
+    def store(self, key: str, artifacts: Artifacts) -> None:
+        self.stats.stores += 1
+        self.stats.evictions += self.memory.put(key, artifacts)
+        if self.disk:
+            self.stats.evictions += self.disk.put(key, artifacts)
+
+    def compile(self, src: str, verbose: bool = False) -> Artifacts:
+        """ Run the whole pipeline on C code, or look its products up
+
+        Args:
+            src (str): The C code.
+            verbose (bool): Whether to annotate the assembly code with comments.
+
+        Returns:
+            Artifacts: The token stream, syntax tree, assembly code and machine code.
+
+        """
+
+        key = cache_key(src, "c", {"verbose": verbose, "machine": default_machine().to_dict()})
+        artifacts = self.lookup(key)
+        if artifacts is not None:
+            return artifacts
+
+        artifacts = run_pipeline(src, verbose)
+        self.store(key, artifacts)
+        return artifacts
+
+    def assemble(self, asm: str) -> bytes:
+        """ Assemble the given assembly code, or look its machine code up
+
+        Args:
+            asm (str): The assembly code.
+
+        Returns:
+            bytes: The machine code.
+
+        """
+
+        key = cache_key(asm, "asm")
+        artifacts = self.lookup(key)
+        if artifacts is None:
+            artifacts = Artifacts(asm=asm, obj=Assembler().assemble_object(asm))
+            self.store(key, artifacts)
+        return artifacts.obj.executable()
+
+
+if __name__ == "__main__":
+    args = sys.argv
+    if len(args) != 2:
+        print("The given number of arguments is invalid.", file=sys.stderr)
+        sys.exit(1)
+
+    cache = CompilationCache(args[1])
+    print(f"{len(cache.disk.entries)} entries, {cache.disk.total} bytes (limit {cache.disk.max_bytes} bytes)")
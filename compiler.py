@@ -1,6 +1,26 @@
+import os
 import sys
 from tokenizer import Tokenizer
-from syntax_tree import Parser, Node, NodeType
+from syntax_tree import Parser, Node, NodeType, Function
+from scheduler import MachineDescription, Scheduler, Instruction, default_machine, render
+from utils import CompileError
+
+# Instructions of the binary operators, with the left operand in t1 and the right one in t0
+BINARY_INSTRUCTIONS = {
+    NodeType.ND_ADD: [("add", "t0", "t1", "t0")],
+    NodeType.ND_SUB: [("sub", "t0", "t1", "t0")],
+    NodeType.ND_MUL: [("mul", "t0", "t1", "t0")],
+    NodeType.ND_DIV: [("div", "t0", "t1", "t0")],
+    NodeType.ND_EQ: [("xor", "t0", "t1", "t0"),
+                     ("seqz", "t0", "t0")],
+    NodeType.ND_NEQ: [("xor", "t0", "t1", "t0"),
+                      ("snez", "t0", "t0")],
+    NodeType.ND_LT: [("slt", "t0", "t1", "t0")],
+    NodeType.ND_LE: [("slt", "t2", "t1", "t0"),   # t2 = t1 < t0
+                     ("xor", "t3", "t1", "t0"),   # t3 = t0 ^ t1
+                     ("seqz", "t3", "t3"),        # t3 = t3 == 0
+                     ("or", "t0", "t2", "t3")],   # t0 = t2 || t3
+}
 
 class Compiler():
     """ C compiler class
@@ -12,11 +32,15 @@ class Compiler():
 
     """
 
-    def __init__(self, parser: Parser) -> None:
+    def __init__(self, parser: Parser, optimize: bool = True, unroll_budget: int = 128,
+                 machine: MachineDescription = None) -> None:
         """ Initialize the compiler class
 
         Args:
-            file_path (str): The name of the file to write the assembly code.
+            parser (Parser): The parser holding the syntax tree.
+            optimize (bool): Whether to run the optimization passes and the instruction scheduler.
+            unroll_budget (int): The number of instructions loop unrolling may add to the program.
+            machine (MachineDescription): The pipeline model to schedule for, by default the one of default_machine.
         
         Returns:
             None: This function does not return anything.
@@ -24,37 +48,131 @@ class Compiler():
         """
 
         self.parser = parser
+        self.optimize = optimize
+        self.unroll_budget = unroll_budget
+        self.machine = machine
+        self.reports: list[str] = []
+        self._passes_done = False
+
+    def _run_passes(self) -> None:
+        """ Run the optimization passes on the syntax tree
+
+        The passes run only once, and their reports are kept in self.reports.
+
+        Args:
+            None: This function does not take any arguments.
+        
+        Returns:
+            None: This function does not return anything.
+
+        """
+
+        from inliner import Inliner
+        from licm import LICM
+        from unroller import Unroller
+        from cse import CSE
+
+        # Invariant expressions leave the loops before they are copied, and the copies
+        # of unrolled loops become blocks whose common subexpressions can be reused
+        self._passes_done = True
+        self.reports += Inliner(self.parser).run()
+        self.reports += LICM(self.parser).run()
+        self.reports += Unroller(self.parser, self.unroll_budget).run()
+        self.reports += CSE(self.parser).run()
+
+    @staticmethod
+    def _is_leaf(func: Function) -> bool:
+        """ Check whether the function calls no other function
+
+        Args:
+            func (Function): The function to check.
+        
+        Returns:
+            bool: True if the body contains no function call.
+
+        """
+
+        stack = list(func.code)
+        while len(stack) > 0:
+            node = stack.pop()
+            if node is None:
+                continue
+            if node.node_type == NodeType.ND_FUNCALL:
+                return False
+            stack += [node.lhs, node.rhs, node.cond, node.then, node.els, node.init, node.inc]
+            stack += node.block or []
+            stack += node.args or []
+        return True
     
     def compile(self, file_path: str, verbose: bool = False) -> None:
         """ Compile the given syntax tree into a RISC-V assembly code
 
         Args:
-            node (Node): The root node of the syntax tree.
+            file_path (str): The name of the file to write the assembly code.
+            verbose (bool): Whether to annotate the assembly code with comments.
         
         Returns:
             None: This function does not return anything.
 
         """
 
-        f = open(file_path, "w")   # Flush the file
-        f.close()
+        with open(file_path, "w") as f:
+            f.write(self.generate(verbose))
 
-        f = open(file_path, "a")
+    def generate(self, verbose: bool = False) -> str:
+        """ Generate the RISC-V assembly code of the given syntax tree
 
-        f.write("main:\n")
+        Args:
+            verbose (bool): Whether to annotate the assembly code with comments.
+        
+        Returns:
+            str: The generated assembly code.
 
-        if verbose:
-            f.write("# initialize sp and fp\n")
+        """
 
-        f.write("   lui t0, 16\n")
-        f.write("   add sp, sp, t0\n")
-        f.write("   add fp, fp, t0\n")
+        return render(self.generate_records(verbose))
 
-        if verbose:
-            f.write("# allocate memory for local variables\n")
+    def generate_records(self, verbose: bool = False) -> list:
+        """ Generate the RISC-V assembly code of the given syntax tree for the assembler
+
+        The instructions are generated as records and handed over to the scheduler and to
+        Assembler.assemble_records as they are, so that they are never formatted and parsed.
+
+        Args:
+            verbose (bool): Whether to annotate the assembly code with comments.
+        
+        Returns:
+            list: The instructions as scheduler.Instruction and the other lines as str.
+
+        """
+
+        if self.optimize and not self._passes_done:
+            self._run_passes()
 
-        f.write(f"   addi sp, sp, -{(self.parser.lvar_offsets[-1]//16 + 1)*16}\n")
-        f.write("\n")
+        code = []
+        base = "fp"     # Register holding the frame base of the current function
+        leaf = False    # Whether the current function calls no other function
+        frame = 0       # Size of the local variable area of the current function
+        constants = {}  # Large constants held in the pool registers in the current basic block
+        pool = ["t4", "t5"]
+
+        def _ins(mnemonic: str, *operands) -> Instruction:
+            # The address of lw and sw is given as the offset and the base register
+            return Instruction(mnemonic, [str(op) for op in operands])
+
+        def _emit(mnemonic: str, *operands) -> None:
+            code.append(_ins(mnemonic, *operands))
+
+        if "main" in [func.name for func in self.parser.functions]:
+            if verbose:
+                code.append("# initialize sp, call main and halt\n")
+
+            _emit("lui", "t0", "16")
+            _emit("add", "sp", "sp", "t0")
+            _emit("jal", "ra", "main")
+            code.append(".Lhalt:\n")
+            _emit("j", ".Lhalt")
+            code.append("\n")
 
         def _pop_operands() -> None:
             """ Pop the operands from the stack
@@ -70,21 +188,21 @@ class Compiler():
             """
 
             if verbose:
-                f.write("# pop operands from the stack\n")
+                code.append("# pop operands from the stack\n")
 
-            f.write("   lw t0, 0(sp)\n")
-            f.write("   lw t1, 16(sp)\n")
-            f.write("   addi sp, sp, 32\n")
+            _emit("lw", "t0", "0", "sp")
+            _emit("lw", "t1", "16", "sp")
+            _emit("addi", "sp", "sp", "32")
         
-        def _push_result() -> None:
+        def _push_result(reg: str = "t0") -> None:
             """ Push the result to the stack
 
-            This function pushes the t0 register's value to the stack.
+            This function pushes the given register's value to the stack.
 
             Be careful that this function overwrite the t1 register.
 
             Args:
-                None: This function does not take any arguments.
+                reg (str): The register holding the result.
             
             Returns:
                 None: This function does not return anything.
@@ -92,261 +210,346 @@ class Compiler():
             """
 
             if verbose:
-                f.write("# push the result to the stack\n")
+                code.append("# push the result to the stack\n")
 
-            f.write("   addi sp, sp, -16\n")
-            f.write("   sw t0, 0(sp)\n")
-        
-        def _gen_lval(node: Node) -> None:
-            if node.node_type != NodeType.ND_LVAR:
-                sys.exit(1)
-            
-            if verbose:
-                f.write("# calculate the address of the local variable\n")
-
-            f.write(f"   addi t0, fp, {node.offset}\n")
-            _push_result()
-            f.write("\n")
+            _emit("addi", "sp", "sp", "-16")
+            _emit("sw", reg, "0", "sp")
 
-        def _gen(node: Node) -> None:
-            """ Recursively compile the syntax tree
+        def _addi(rd: str, rs: str, imm: int) -> None:
+            """ Add an immediate of any size to a register
 
-            This function recursively compiles the syntax tree.
+            Immediates beyond the 12 bits of addi are materialized in t0 first,
+            so rs must not be t0 in that case.
 
             Args:
-                node (Node): The current node to compile.
+                rd (str): The destination register.
+                rs (str): The source register.
+                imm (int): The immediate to add.
             
             Returns:
                 None: This function does not return anything.
 
             """
 
-            if node.node_type == NodeType.ND_NUM:
-                if verbose:
-                    f.write("# load the number to the stack\n")
-
-                f.write(f"   li t0, {node.val}\n")
-                _push_result()
-                f.write("\n")
+            if -2048 <= imm < 2048:
+                _emit("addi", rd, rs, imm)
+            else:
+                _emit("li", "t0", imm)
+                _emit("add", rd, rs, "t0")
 
-                return None
-                
-            elif node.node_type == NodeType.ND_LVAR:
-                if verbose:
-                    f.write("# local variable access\n")
+        def _gen_num(val: int) -> None:
+            """ Push a number to the stack
 
-                _gen_lval(node)
+            Numbers beyond the 12 bits of addi take two instructions to materialize, so
+            they are kept in the pool registers and reused until the end of the basic block.
 
-                if verbose:
-                    f.write("# load the value of the local variable to the stack\n")
+            Args:
+                val (int): The number to push.
+            
+            Returns:
+                None: This function does not return anything.
 
-                f.write("   lw t0, 0(sp)\n")
-                f.write("   lw t0, 0(t0)\n")
-                f.write("   sw t0, 0(sp)\n")
-                f.write("\n")
+            """
 
-                return None
+            if -2048 <= val < 2048:
+                _emit("li", "t0", val)
+                _push_result()
+                return
+
+            if val not in constants:
+                reg = pool[len(constants) % len(pool)]
+                for held in [v for v, r in constants.items() if r == reg]:
+                    del constants[held]
+                _emit("li", reg, val)
+                constants[val] = reg
+            _push_result(constants[val])
+
+        def _label(name: str) -> None:
+            # Control can reach a label from elsewhere, so the pool registers are unknown past it
+            constants.clear()
+            code.append(f"{name}:\n")
+
+        def _call(name: str) -> None:
+            # The callee may overwrite the caller-saved pool registers
+            _emit("jal", "ra", name)
+            constants.clear()
+        
+        def _gen_lval(node: Node) -> None:
+            if node.node_type != NodeType.ND_LVAR:
+                raise CompileError("The left-hand side of the assignment is not a variable.")
             
-            elif node.node_type == NodeType.ND_ASSIGN:
-                if verbose:
-                    f.write("# assign the value to the local variable\n")
+            if verbose:
+                code.append("# calculate the address of the local variable\n")
 
-                _gen_lval(node.lhs)
-                _gen(node.rhs)
-                _pop_operands()
+            _addi("t0", base, -node.offset)
+            _push_result()
+            code.append("\n")
 
-                if verbose:
-                    f.write("# store the value to the local variable\n")
+        def _gen_prologue(func: Function) -> None:
+            """ Set up the frame of the function
 
-                f.write("   sw t0, 0(t1)\n")
-                _push_result()
-                f.write("\n")
+            Non-leaf functions save ra and fp and use fp as the frame base. Leaf functions
+            keep the frame base in the caller-saved t6 instead, so that they touch neither
+            ra nor fp, and functions without local variables do not set up a frame at all.
 
-                return None
+            Args:
+                func (Function): The function to compile.
             
-            elif node.node_type == NodeType.ND_RETURN:
-                if verbose:
-                    f.write("# return\n")
+            Returns:
+                None: This function does not return anything.
 
-                _gen(node.lhs)
+            """
 
-                if verbose:
-                    f.write("# return the value\n")
+            if verbose:
+                code.append("# prologue\n")
+
+            if not leaf and frame + 16 <= 2048:
+                _emit("addi", "sp", "sp", -(frame + 16))
+                _emit("sw", "ra", frame + 4, "sp")
+                _emit("sw", "fp", frame, "sp")
+                _emit("addi", "fp", "sp", frame)
+
+            elif not leaf:
+                # The offsets of the saved registers would not fit in 12 bits, so save them first
+                _emit("addi", "sp", "sp", "-16")
+                _emit("sw", "ra", "4", "sp")
+                _emit("sw", "fp", "0", "sp")
+                _emit("mv", "fp", "sp")
+                _addi("sp", "sp", -frame)
+
+            elif frame > 0:
+                _emit("mv", "t6", "sp")
+                _addi("sp", "sp", -frame)
+
+            if verbose and len(func.params) > 0:
+                code.append("# store the arguments to the parameters\n")
+
+            for i, offset in enumerate(func.params):
+                if frame - offset < 2048:
+                    _emit("sw", f"a{i}", frame - offset, "sp")
+                else:
+                    _addi("t0", base, -offset)
+                    _emit("sw", f"a{i}", "0", "t0")
+            code.append("\n")
 
-                f.write("   lw a0, 0(sp)\n")
-                f.write("   addi sp, sp, 16\n")
-                f.write("   mv sp, fp\n")
-                f.write("   lw fp, 0(sp)\n")
-                f.write("   addi sp, sp, 16\n")
-                f.write("   ret\n")
-                f.write("\n")
+        def _gen_epilogue() -> None:
+            if verbose:
+                code.append("# epilogue\n")
 
-                return None
-            
-            elif node.node_type == NodeType.ND_IF:
-                if verbose:
-                    f.write("# if statement\n")
-                    f.write("# condition\n")
+            if not leaf:
+                _emit("lw", "ra", "4", "fp")
+                _emit("addi", "sp", "fp", "16")
+                _emit("lw", "fp", "0", "fp")
 
-                _gen(node.cond)
-                f.write("   lw t0, 0(sp)\n")
-                f.write("   addi sp, sp, 16\n")
+            elif frame > 0:
+                _emit("mv", "sp", "t6")
 
-                if node.els:
-                    if verbose:
-                        f.write("# if-else statement\n")
+            _emit("ret")
+            code.append("\n")
 
-                    f.write(f"   beqz t0, {node.labels[1]}\n")
+        def _comment(text: str) -> list:
+            return [f"# {text}\n"] if verbose else []
 
-                    if verbose:
-                        f.write("# then\n")
+        def _stmt(node: Node) -> list:
+            """ Schedule a statement
 
-                    _gen(node.then)
-                    f.write(f"   j {node.labels[0]}\n")
-                    f.write("\n")
-                    f.write(f"{node.labels[1]}:\n")
+            The value of an expression statement is popped to a0, so that every statement
+            leaves the stack as it found it.
 
-                    if verbose:
-                        f.write("# else\n")
+            Args:
+                node (Node): The statement to compile.
+            
+            Returns:
+                list: The work items compiling the statement.
 
-                    _gen(node.els)
+            """
 
-                else:
-                    f.write(f"   beqz t0, {node.labels[0]}\n")
+            if node.node_type in (NodeType.ND_RETURN, NodeType.ND_IF, NodeType.ND_FOR, NodeType.ND_BLOCK):
+                return [node]
 
-                    if verbose:
-                        f.write("# then\n")
+            return [node, _ins("lw", "a0", "0", "sp"), _ins("addi", "sp", "sp", "16"), "\n"]
 
-                    _gen(node.then)
+        def _discard(node: Node) -> list:
+            return [node, _ins("addi", "sp", "sp", "16")]
 
-                f.write(f"{node.labels[0]}:\n")
+        def _expand(node: Node) -> list:
+            """ Expand a node into the work items compiling it
 
-                return None
+            A work item is an instruction, a label, comment or blank line, a callable emitting
+            code, or a child node to be expanded in turn, in the order they are to be processed.
 
-            elif node.node_type == NodeType.ND_FOR:
-                if verbose:
-                    f.write("# for statement\n")
+            Args:
+                node (Node): The current node to compile.
+            
+            Returns:
+                list: The work items compiling the node.
 
-                if node.init:
-                    if verbose:
-                        f.write("# init\n")
+            """
 
-                    _gen(node.init)
+            if node.node_type == NodeType.ND_NUM:
+                return [*_comment("load the number to the stack"),
+                        lambda: _gen_num(node.val), "\n"]
+                
+            elif node.node_type == NodeType.ND_LVAR:
+                return [*_comment("local variable access"),
+                        lambda: _gen_lval(node),
+                        *_comment("load the value of the local variable to the stack"),
+                        _ins("lw", "t0", "0", "sp"),
+                        _ins("lw", "t0", "0", "t0"),
+                        _ins("sw", "t0", "0", "sp"),
+                        "\n"]
+            
+            elif node.node_type == NodeType.ND_ASSIGN:
+                return [*_comment("assign the value to the local variable"),
+                        lambda: _gen_lval(node.lhs),
+                        node.rhs,
+                        _pop_operands,
+                        *_comment("store the value to the local variable"),
+                        _ins("sw", "t0", "0", "t1"),
+                        _push_result,
+                        "\n"]
+            
+            elif node.node_type == NodeType.ND_RETURN:
+                return [*_comment("return"),
+                        node.lhs,
+                        *_comment("return the value"),
+                        _ins("lw", "a0", "0", "sp"),
+                        _ins("addi", "sp", "sp", "16"),
+                        _gen_epilogue]
+            
+            elif node.node_type == NodeType.ND_COMMA:
+                return [*_discard(node.lhs), node.rhs]
+            
+            elif node.node_type == NodeType.ND_FUNCALL:
+                items = [*_comment(f"call {node.name}"), *node.args]
 
-                f.write(f"{node.labels[0]}:\n")
+                if len(node.args) > 0:
+                    items += _comment("pass the arguments in a0-a7")
 
-                if node.cond:
-                    if verbose:
-                        f.write("# condition\n")
+                for i in range(len(node.args)):
+                    items.append(_ins("lw", f"a{i}", (len(node.args) - 1 - i)*16, "sp"))
 
-                    _gen(node.cond)
-                    f.write("   lw t0, 0(sp)\n")
-                    f.write("   addi sp, sp, 16\n")
-                    f.write(f"   beqz t0, {node.labels[1]}\n")
-                
-                if verbose:
-                    f.write("# then\n")
+                if len(node.args) > 0:
+                    items.append(_ins("addi", "sp", "sp", len(node.args)*16))
 
-                _gen(node.then)
+                # Intermediate values live on the stack and fp is callee-saved,
+                # so no register has to be saved around the call
+                return items + [lambda: _call(node.name), _ins("mv", "t0", "a0"), _push_result, "\n"]
+            
+            elif node.node_type == NodeType.ND_IF:
+                items = [*_comment("if statement"),
+                         *_comment("condition"),
+                         node.cond,
+                         _ins("lw", "t0", "0", "sp"),
+                         _ins("addi", "sp", "sp", "16")]
 
-                if node.inc:
-                    if verbose:
-                        f.write("# increment\n")
+                if node.els:
+                    items += [*_comment("if-else statement"),
+                              _ins("beqz", "t0", node.labels[1]),
+                              *_comment("then"),
+                              *_stmt(node.then),
+                              _ins("j", node.labels[0]),
+                              "\n",
+                              lambda: _label(node.labels[1]),
+                              *_comment("else"),
+                              *_stmt(node.els)]
 
-                    _gen(node.inc)
-                
-                f.write(f"   j {node.labels[0]}\n")
-                f.write(f"{node.labels[1]}:\n")
+                else:
+                    items += [_ins("beqz", "t0", node.labels[0]),
+                              *_comment("then"),
+                              *_stmt(node.then)]
 
-                if node.cond:
-                    if verbose:
-                        f.write("# end of for statement\n")
+                return items + [lambda: _label(node.labels[0])]
 
-                    _gen(node.cond)
-                    f.write("   lw t0, 0(sp)\n")
-                    f.write("   addi sp, sp, 16\n")
-                    f.write(f"   beqz t0, {node.labels[1]}\n")
-                
-                if verbose:
-                    f.write("# then\n")
+            elif node.node_type == NodeType.ND_FOR:
+                items = _comment("for statement")
 
-                _gen(node.then)
+                if node.init:
+                    items += [*_comment("init"), *_discard(node.init)]
 
-                if node.inc:
-                    if verbose:
-                        f.write("# increment\n")
+                items.append(lambda: _label(node.labels[0]))
 
-                    _gen(node.inc)
+                if node.cond:
+                    items += [*_comment("condition"),
+                              node.cond,
+                              _ins("lw", "t0", "0", "sp"),
+                              _ins("addi", "sp", "sp", "16"),
+                              _ins("beqz", "t0", node.labels[1])]
+                
+                items += [*_comment("then"), *_stmt(node.then)]
 
-                f.write(f"   j {node.labels[0]}\n")
-                f.write(f"{node.labels[1]}:\n")
+                if node.inc:
+                    items += [*_comment("increment"), *_discard(node.inc)]
                 
-                return None
+                return items + [_ins("j", node.labels[0]), lambda: _label(node.labels[1])]
             
             elif node.node_type == NodeType.ND_BLOCK:
-                if verbose:
-                    f.write("# block statement\n")
-                    
+                items = _comment("block statement")
                 for stmt in node.block:
-                    _gen(stmt)
-                    f.write("   lw a0, 0(sp)\n")
-                    f.write("   addi sp, sp, 16\n")
-                    f.write("\n")
-
-                return None
+                    items += _stmt(stmt)
+                return items
             
-            _gen(node.lhs)      # Generate the left node
-            _gen(node.rhs)      # Generate the right node
-            _pop_operands()     # Pop the operands from the stack
-            # left node is in t1, right node is in t0
+            if node.node_type not in BINARY_INSTRUCTIONS:
+                raise CompileError(f"Unknown node type: {node.node_type}")
 
-            if verbose:
-                f.write("# binary operation\n")
+            # left node ends up in t1, right node in t0
+            return [node.lhs,
+                    node.rhs,
+                    _pop_operands,
+                    *_comment("binary operation"),
+                    *[_ins(*ins) for ins in BINARY_INSTRUCTIONS[node.node_type]],
+                    _push_result,
+                    "\n"]
 
-            if node.node_type == NodeType.ND_ADD:         
-                f.write("   add t0, t1, t0\n")  # Add the operands
+        def _gen(*items) -> None:
+            """ Compile the given work items
 
-            elif node.node_type == NodeType.ND_SUB:
-                f.write("   sub t0, t1, t0\n")
-            
-            elif node.node_type == NodeType.ND_MUL:
-                f.write("   mul t0, t1, t0\n")
-            
-            elif node.node_type == NodeType.ND_DIV:
-                f.write("   div t0, t1, t0\n")
-            
-            elif node.node_type == NodeType.ND_EQ:
-                f.write("   xor t0, t1, t0\n")
-                f.write("   seqz t0, t0\n")
-            
-            elif node.node_type == NodeType.ND_NEQ:
-                f.write("   xor t0, t1, t0\n")
-                f.write("   snez t0, t0\n")
+            The syntax tree is walked with an explicit stack of work items instead of recursion,
+            so that deeply nested statements and expressions do not exhaust the Python stack.
 
-            elif node.node_type == NodeType.ND_LT:
-                f.write("   slt t0, t1, t0\n")
-            
-            elif node.node_type == NodeType.ND_LE:
-                f.write("   slt t2, t1, t0\n")  # t2 = t1 < t0
-                f.write("   xor t3, t1, t0\n")  # t3 = t0 ^ t1
-                f.write("   seqz t3, t3\n")     # t3 = t3 == 0
-                f.write("   or t0, t2, t3\n")   # t0 = t2 || t3
+            Args:
+                items: The work items to process, in order.
             
-            else:
-                sys.exit(1)
+            Returns:
+                None: This function does not return anything.
 
-            _push_result()      # Push the result to the stack
-            f.write("\n")
+            """
 
-            return None
+            work = list(reversed(items))
+            while len(work) > 0:
+                item = work.pop()
+                if isinstance(item, Node):
+                    work += reversed(_expand(item))
+                elif callable(item):
+                    item()
+                else:
+                    code.append(item)
             
-        for node in self.parser.code:
-            _gen(node)
-            f.write("   lw a0, 0(sp)\n")
-            f.write("   addi sp, sp, 16\n")
-            f.write("\n")
-        
-        f.close()
+        for func in self.parser.functions:
+            leaf = Compiler._is_leaf(func)
+            base = "t6" if leaf else "fp"
+            frame = -(-func.lvar_offsets[-1] // 16) * 16
+
+            _label(func.name)
+            _gen_prologue(func)
+
+            for node in func.code:
+                _gen(*_stmt(node))
+
+            if len(func.code) == 0 or func.code[-1].node_type != NodeType.ND_RETURN:
+                _gen_epilogue()
+
+        reports = list(self.reports)
+        if self.optimize:
+            scheduler = Scheduler(self.machine or default_machine())
+            records = scheduler.schedule_records(code)
+            reports.append(scheduler.report())
+        else:
+            records = code
+
+        if verbose:
+            records = [f"# {line}\n" for line in reports] + records
+        return records
 
 
 if __name__ == "__main__":
@@ -355,10 +558,24 @@ if __name__ == "__main__":
         print("The given number of arguments is invalid.", file=sys.stderr)
         sys.exit(1)
 
-    
-    tokenizer = Tokenizer()
-    tokenizer.tokenize(open(args[1], "r").read())
-    parser = Parser(tokenizer)
-    parser.parse()
-    compiler = Compiler(parser)
-    compiler.compile(args[2], True)
+    src = open(args[1], "r").read()
+
+    try:
+        if os.environ.get("TC_CACHE_DIR"):
+            from cache import CompilationCache
+            cache = CompilationCache(os.environ["TC_CACHE_DIR"])
+            with open(args[2], "w") as f:
+                f.write(cache.compile(src, True).asm)
+            print(f"cache: {cache.stats}", file=sys.stderr)
+
+        else:
+            tokenizer = Tokenizer()
+            tokenizer.tokenize(src)
+            parser = Parser(tokenizer)
+            parser.parse()
+            compiler = Compiler(parser)
+            compiler.compile(args[2], True)
+
+    except CompileError as e:
+        print(e, file=sys.stderr)
+        sys.exit(1)
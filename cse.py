@@ -0,0 +1,186 @@
+from syntax_tree import Parser, Node, NodeType, Function
+from unroller import estimate_size
+
+# Operators without side effects, whose operands are the only thing their value depends on
+PURE_OPS = {
+    NodeType.ND_ADD: "+", NodeType.ND_SUB: "-", NodeType.ND_MUL: "*", NodeType.ND_DIV: "/",
+    NodeType.ND_EQ: "==", NodeType.ND_NEQ: "!=", NodeType.ND_LT: "<", NodeType.ND_LE: "<=",
+}
+
+# Largest expression, in syntax tree nodes, that is compared with others
+MAX_KEY_SIZE = 32
+
+# Instructions of reading a temporary and of assigning one (see Compiler.generate)
+READ_COST = 6
+ASSIGN_COST = 9
+
+
+def new_slot(func: Function, tag: str) -> int:
+    func.l_vars.append(f".{tag}{len(func.l_vars)}")
+    func.lvar_offsets.append(func.lvar_offsets[-1] + 4)
+    return func.lvar_offsets[-1]
+
+
+def describe(node: Node, names: dict) -> str:
+    """ Render a pure expression of at most MAX_KEY_SIZE nodes as C code for the reports """
+
+    if node.node_type == NodeType.ND_NUM:
+        return str(node.val)
+    if node.node_type == NodeType.ND_LVAR:
+        return names.get(node.offset, "?")
+
+    operands = []
+    for child in (node.lhs, node.rhs):
+        text = describe(child, names)
+        operands.append(f"({text})" if child.node_type in PURE_OPS else text)
+    return f"{operands[0]} {PURE_OPS[node.node_type]} {operands[1]}"
+
+
+class CSE():
+    """ Eliminate common subexpressions within basic blocks
+
+    A basic block is a run of expression statements, together with the condition of an if
+    statement, the initialization of a loop or the value of a return that ends it. Blocks
+    nested in it are part of the run. Subexpressions are numbered by value, with every
+    assignment starting a new version of its variable, so two occurrences of the same
+    number compute the same value. The first one is assigned to a fresh temporary and the
+    others read it, when the estimated instructions saved exceed the cost of the temporary.
+
+    Attributes:
+        parser (Parser): The parser holding the functions to transform.
+        eliminated (int): The number of occurrences replaced by a temporary.
+        saved (int): The estimated number of instructions saved.
+
+    """
+
+    def __init__(self, parser: Parser) -> None:
+        self.parser = parser
+        self.eliminated = 0
+        self.saved = 0
+        self._report: list[str] = []
+
+    def _blocks(self, func: Function):
+        """ Yield the expressions of every basic block of the function, in the order they are evaluated """
+
+        lists = [func.code]
+        while len(lists) > 0:
+            work = list(reversed(lists.pop()))
+            exprs = []
+            while len(work) > 0:
+                stmt = work.pop()
+                if stmt.node_type == NodeType.ND_BLOCK:
+                    work += reversed(stmt.block)
+                    continue
+
+                if stmt.node_type == NodeType.ND_RETURN:
+                    exprs.append(stmt.lhs)
+
+                elif stmt.node_type == NodeType.ND_IF:
+                    exprs.append(stmt.cond)
+                    lists += [[stmt.then]] + ([[stmt.els]] if stmt.els else [])
+
+                elif stmt.node_type == NodeType.ND_FOR:
+                    if stmt.init:
+                        exprs.append(stmt.init)
+                    lists.append([stmt.then])
+
+                else:
+                    exprs.append(stmt)
+                    continue
+
+                yield exprs
+                exprs = []
+            yield exprs
+
+    def _number(self, exprs: list[Node]) -> tuple[dict, dict]:
+        """ Number the subexpressions of a basic block by value
+
+        Returns:
+            tuple[dict, dict]: The occurrences of every operator expression, in the order they are evaluated,
+            and the size of every expression.
+
+        """
+
+        keys = {}
+        sizes = {}
+        versions = {}
+        occurrences = {}
+        stack = [(expr, False) for expr in reversed(exprs)]
+        while len(stack) > 0:
+            node, visited = stack.pop()
+            if not visited:
+                stack.append((node, True))
+                if node.node_type == NodeType.ND_ASSIGN:
+                    children = [node.rhs]   # The left-hand side is an address, not a value
+                elif node.node_type == NodeType.ND_FUNCALL:
+                    children = node.args
+                else:
+                    children = [node.lhs, node.rhs]
+                stack += [(child, False) for child in reversed(children) if child is not None]
+                continue
+
+            key = None
+            if node.node_type == NodeType.ND_NUM:
+                key, sizes[id(node)] = ("num", node.val), 1
+            elif node.node_type == NodeType.ND_LVAR:
+                key, sizes[id(node)] = ("var", node.offset, versions.get(node.offset, 0)), 1
+            elif node.node_type in PURE_OPS and keys.get(id(node.lhs)) and keys.get(id(node.rhs)):
+                sizes[id(node)] = sizes[id(node.lhs)] + sizes[id(node.rhs)] + 1
+                if sizes[id(node)] <= MAX_KEY_SIZE:
+                    key = (node.node_type, keys[id(node.lhs)], keys[id(node.rhs)])
+                    occurrences.setdefault(key, []).append(node)
+            elif node.node_type == NodeType.ND_ASSIGN:
+                versions[node.lhs.offset] = versions.get(node.lhs.offset, 0) + 1
+            keys[id(node)] = key
+
+        return occurrences, sizes
+
+    def _eliminate(self, func: Function, exprs: list[Node]) -> None:
+        occurrences, sizes = self._number(exprs)
+
+        # Larger expressions first, their occurrences take the ones nested in them along
+        removed = set()
+        for key in sorted(occurrences, key=lambda key: -sizes[id(occurrences[key][0])]):
+            nodes = [node for node in occurrences[key] if id(node) not in removed]
+            if len(nodes) < 2:
+                continue
+
+            size = estimate_size(nodes[0], False)
+            saved = (len(nodes) - 1) * (size - READ_COST) - ASSIGN_COST
+            if saved <= 0:
+                continue
+
+            names = dict(zip(func.lvar_offsets, func.l_vars))
+            self._report.append(f"reused {describe(nodes[0], names)} {len(nodes) - 1} times in {func.name}")
+            tmp = new_slot(func, "cse")
+            first = Node.__new__(Node)
+            first.__dict__.update(nodes[0].__dict__)
+            nodes[0].__dict__.update(Node(NodeType.ND_ASSIGN, Node(NodeType.ND_LVAR, offset=tmp), first).__dict__)
+
+            for node in nodes[1:]:
+                stack = [node]
+                while len(stack) > 0:
+                    child = stack.pop()
+                    removed.add(id(child))
+                    stack += [grandchild for grandchild in (child.lhs, child.rhs) if grandchild is not None]
+                node.__dict__.update(Node(NodeType.ND_LVAR, offset=tmp).__dict__)
+
+            self.eliminated += len(nodes) - 1
+            self.saved += saved
+
+    def run(self) -> list[str]:
+        """ Eliminate the common subexpressions of every function
+
+        Returns:
+            list[str]: The report of the reused expressions and the instructions saved.
+
+        """
+
+        for func in self.parser.functions:
+            for exprs in self._blocks(func):
+                if len(exprs) > 0:
+                    self._eliminate(func, exprs)
+
+        if self.eliminated == 0:
+            return []
+        return self._report + [f"cse: {self.eliminated} occurrences reused, instructions -{self.saved} (estimated)"]
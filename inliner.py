@@ -0,0 +1,159 @@
+from syntax_tree import Parser, Node, NodeType, Function, walk, clone
+from unroller import estimate_size
+
+
+class InlineSite():
+    def __init__(self, caller: str, callee: str, depth: int, size: int) -> None:
+        self.caller = caller
+        self.callee = callee
+        self.depth = depth
+        self.size = size
+
+    def __str__(self) -> str:
+        return f"inlined {self.callee} into {self.caller} (depth {self.depth}, instructions {self.size:+d})"
+
+
+class Inliner():
+    """ Inline small functions into their callers
+
+    A call site is replaced by a comma expression that assigns the arguments to fresh
+    slots in the caller's frame, evaluates the expression statements of the callee and
+    yields its return value. Only callees whose body is a sequence of expression
+    statements, optionally ending with a return, and whose size is within the budget
+    are inlined. Calls that appear in inlined bodies are considered again up to
+    max_depth levels, which bounds the expansion of recursive functions.
+
+    Attributes:
+        parser (Parser): The parser holding the functions to transform.
+        max_size (int): The largest callee, in syntax tree nodes, to inline.
+        max_depth (int): The deepest level of nested inlining.
+        sites (list[InlineSite]): The inlined call sites.
+
+    """
+
+    def __init__(self, parser: Parser, max_size: int = 16, max_depth: int = 2) -> None:
+        self.parser = parser
+        self.max_size = max_size
+        self.max_depth = max_depth
+        self.sites: list[InlineSite] = []
+        self._slots = 0
+
+    def _body_size(self, func: Function) -> int:
+        return sum(1 for stmt in func.code for _ in walk(stmt))
+
+    def _is_inlinable(self, func: Function) -> bool:
+        if self._body_size(func) > self.max_size:
+            return False
+
+        for i, stmt in enumerate(func.code):
+            for node in walk(stmt):
+                if node.node_type in (NodeType.ND_IF, NodeType.ND_FOR, NodeType.ND_BLOCK):
+                    return False
+                if node.node_type == NodeType.ND_RETURN and (node is not stmt or i != len(func.code) - 1):
+                    return False
+        return True
+
+    def _new_slot(self, caller: Function, name: str) -> int:
+        self._slots += 1
+        caller.l_vars.append(f"{name}.inl{self._slots}")
+        caller.lvar_offsets.append(caller.lvar_offsets[-1] + 4)
+        return caller.lvar_offsets[-1]
+
+    def _may_have_side_effects(self, args: list[Node]) -> bool:
+        # Look at a bounded number of nodes, so that deeply nested calls stay linear in time
+        seen = 0
+        for arg in args:
+            for node in walk(arg):
+                seen += 1
+                if seen > self.max_size or node.node_type in (NodeType.ND_ASSIGN, NodeType.ND_FUNCALL, NodeType.ND_COMMA):
+                    return True
+        return False
+
+    def _expand(self, caller: Function, callee: Function, call: Node) -> tuple[Node, list[Node], int]:
+        # A parameter the callee never assigns can take a constant or variable argument
+        # directly, unless evaluating another argument may change that variable
+        assigned = set(node.lhs.offset for stmt in callee.code for node in walk(stmt)
+                       if node.node_type == NodeType.ND_ASSIGN)
+        side_effects = self._may_have_side_effects(call.args)
+        substitute = {}
+        for param, arg in zip(callee.params, call.args):
+            if param in assigned:
+                continue
+            if arg.node_type == NodeType.ND_NUM or (arg.node_type == NodeType.ND_LVAR and not side_effects):
+                substitute[param] = arg
+
+        # Give every other local variable of the callee its own slot in the caller's frame
+        remap = {}
+        for name, offset in zip(callee.l_vars[1:], callee.lvar_offsets[1:]):
+            if offset not in substitute:
+                remap[offset] = self._new_slot(caller, f"{callee.name}.{name}")
+
+        body = [clone(stmt) for stmt in callee.code]
+        calls = []
+        for stmt in body:
+            for node in walk(stmt):
+                if node.node_type == NodeType.ND_FUNCALL:
+                    calls.append(node)
+                if node.node_type != NodeType.ND_LVAR:
+                    continue
+                if node.offset in substitute:
+                    node.__dict__.update(clone(substitute[node.offset]).__dict__)
+                else:
+                    node.offset = remap[node.offset]
+
+        if len(body) > 0 and body[-1].node_type == NodeType.ND_RETURN:
+            result = body.pop().lhs
+        elif len(body) > 0:
+            result = body.pop()     # Without return, a0 holds the value of the last statement
+        else:
+            result = Node(NodeType.ND_NUM, val=0)
+
+        exprs = []
+        for param, arg in zip(callee.params, call.args):
+            if param in substitute:
+                continue
+            exprs.append(Node(NodeType.ND_ASSIGN, Node(NodeType.ND_LVAR, offset=remap[param]), arg))
+        exprs += body
+
+        node = result
+        for expr in reversed(exprs):
+            node = Node(NodeType.ND_COMMA, expr, node)
+
+        # The arguments assigned to slots move over as they are, so they count the same on both sides
+        moved = {id(arg) for param, arg in zip(callee.params, call.args) if param not in substitute}
+        return node, calls, estimate_size(node, False, moved) - estimate_size(call, False, moved)
+
+    def run(self) -> list[str]:
+        """ Inline the call sites of every function
+
+        Returns:
+            list[str]: The report of the inlined call sites and the change in instructions.
+
+        """
+
+        functions = {func.name: func for func in self.parser.functions}
+        inlinable = {name: self._is_inlinable(func) for name, func in functions.items()}
+
+        for caller in self.parser.functions:
+            worklist = [(node, 1) for stmt in caller.code for node in walk(stmt)
+                        if node.node_type == NodeType.ND_FUNCALL]
+            while len(worklist) > 0:
+                call, depth = worklist.pop()
+                callee = functions.get(call.name)
+                if callee is None or not inlinable[call.name] or depth > self.max_depth:
+                    continue
+                if len(call.args) != len(callee.params):
+                    continue
+
+                # Calls in the arguments are already in the worklist, those of the body go one level deeper
+                expanded, calls, size = self._expand(caller, callee, call)
+                call.__dict__.update(expanded.__dict__)
+                self.sites.append(InlineSite(caller.name, callee.name, depth, size))
+                worklist += [(call if node is expanded else node, depth + 1) for node in calls]
+
+        if len(self.sites) == 0:
+            return []
+
+        report = [str(site) for site in self.sites]
+        report.append(f"inlining: {len(self.sites)} call sites, instructions {sum(site.size for site in self.sites):+d} (estimated)")
+        return report
@@ -0,0 +1,178 @@
+from bisect import bisect_left
+from syntax_tree import Parser, Node, NodeType, Function
+from cse import PURE_OPS, MAX_KEY_SIZE, new_slot, describe
+
+# Most variables an expression may read to be considered, and most loops it is hoisted out of
+MAX_VARS = 8
+MAX_LEVELS = 8
+
+
+class Loop():
+    def __init__(self, node: Node, start: int, parent: int) -> None:
+        self.node = node
+        self.start = start      # Position of the loop statement, before its initialization
+        self.enter = None       # Position of the condition, the first node evaluated in every iteration
+        self.exit = None        # Position past the last node of the loop
+        self.parent = parent    # Index of the enclosing loop, or -1
+        self.hoisted: list[Node] = []
+        self.temporaries: dict = {}
+
+
+class LICM():
+    """ Move loop-invariant expressions out of loops
+
+    An operator expression in the condition, body or increment of a loop is invariant
+    when none of the variables it reads is assigned anywhere in them. Such an expression
+    is computed once into a temporary by the initialization of the loop, in front of the
+    original initialization, and read from the temporary on every iteration. Expressions
+    are hoisted as far out as they stay invariant, and identical expressions hoisted out
+    of the same loop share their temporary.
+
+    Nodes are numbered in the order they are evaluated, so that a loop covers a range of
+    positions and whether a variable is assigned in it is a binary search among the
+    positions of its assignments. This keeps deeply nested loops linear in time.
+
+    Attributes:
+        parser (Parser): The parser holding the functions to transform.
+        hoisted (int): The number of expressions moved out of loops.
+
+    """
+
+    def __init__(self, parser: Parser) -> None:
+        self.parser = parser
+        self.hoisted = 0
+        self._report: list[str] = []
+
+    def _number(self, func: Function) -> tuple[list[Node], list[int], list[Loop], dict]:
+        """ Number the nodes of the function and record its loops and assignments
+
+        Returns:
+            tuple: The nodes in pre-order, the innermost loop of each node, the loops and
+            the positions of the assignments to each variable.
+
+        """
+
+        nodes = []
+        inside = []
+        loops = []
+        assigns = {}
+        stack = [("node", stmt, -1) for stmt in reversed(func.code)]
+        while len(stack) > 0:
+            kind, node, loop = stack.pop()
+            if kind == "enter":
+                loops[loop].enter = len(nodes)
+                continue
+            if kind == "exit":
+                loops[loop].exit = len(nodes)
+                continue
+            if node is None:
+                continue
+
+            if node.node_type == NodeType.ND_ASSIGN:
+                assigns.setdefault(node.lhs.offset, []).append(len(nodes))
+            nodes.append(node)
+            inside.append(loop)
+
+            if node.node_type == NodeType.ND_FOR:
+                # The initialization runs once, outside of the loop
+                loops.append(Loop(node, len(nodes) - 1, loop))
+                index = len(loops) - 1
+                stack += [("exit", None, index), ("node", node.inc, index), ("node", node.then, index),
+                          ("node", node.cond, index), ("enter", None, index), ("node", node.init, loop)]
+                continue
+
+            children = [node.lhs, node.rhs, node.cond, node.then, node.els, node.init, node.inc]
+            children += (node.block or []) + (node.args or [])
+            stack += [("node", child, loop) for child in reversed(children)]
+
+        return nodes, inside, loops, assigns
+
+    @staticmethod
+    def _assigned(assigns: dict, var: int, start: int, end: int) -> bool:
+        positions = assigns.get(var, [])
+        i = bisect_left(positions, start)
+        return i < len(positions) and positions[i] < end
+
+    def _hoist(self, func: Function) -> None:
+        nodes, inside, loops, assigns = self._number(func)
+        if len(loops) == 0:
+            return
+
+        # The variables read by every pure expression, bottom-up (children follow their parent in pre-order)
+        position = {id(node): i for i, node in enumerate(nodes)}
+        reads = [None] * len(nodes)
+        sizes = [0] * len(nodes)
+        for i in range(len(nodes) - 1, -1, -1):
+            node = nodes[i]
+            if node.node_type == NodeType.ND_NUM:
+                reads[i], sizes[i] = frozenset(), 1
+            elif node.node_type == NodeType.ND_LVAR:
+                reads[i], sizes[i] = frozenset([node.offset]), 1
+            elif node.node_type in PURE_OPS:
+                lhs, rhs = position[id(node.lhs)], position[id(node.rhs)]
+                if reads[lhs] is not None and reads[rhs] is not None and len(reads[lhs] | reads[rhs]) <= MAX_VARS:
+                    reads[i], sizes[i] = reads[lhs] | reads[rhs], sizes[lhs] + sizes[rhs] + 1
+
+        names = dict(zip(func.lvar_offsets, func.l_vars))
+        moves = []
+        skip = 0
+        for i, node in enumerate(nodes):
+            if i < skip or node.node_type not in PURE_OPS or reads[i] is None or inside[i] == -1:
+                continue
+
+            # Climb out of the loops the expression stays invariant in
+            target = None
+            index = inside[i]
+            for _ in range(MAX_LEVELS):
+                if index == -1:
+                    break
+                loop = loops[index]
+                if any(LICM._assigned(assigns, var, loop.enter, loop.exit) for var in reads[i]):
+                    break
+                # The temporary is assigned ahead of the original initialization, which must leave the expression alone
+                if any(LICM._assigned(assigns, var, loop.start, loop.enter) for var in reads[i]):
+                    break
+                target = index
+                index = loop.parent
+
+            if target is not None:
+                moves.append((target, node, sizes[i]))
+                skip = i + sizes[i]     # Expressions nested in a hoisted one go along with it
+
+        for target, node, size in moves:
+            loop = loops[target]
+            moved = Node.__new__(Node)
+            moved.__dict__.update(node.__dict__)
+
+            key = describe(moved, names) if size <= MAX_KEY_SIZE else None
+            if key is None or key not in loop.temporaries:
+                tmp = new_slot(func, "licm")
+                if key is not None:
+                    loop.temporaries[key] = tmp
+                loop.hoisted.append(Node(NodeType.ND_ASSIGN, Node(NodeType.ND_LVAR, offset=tmp), moved))
+                self._report.append(f"hoisted {key or 'expression'} out of {loop.node.labels[0]} in {func.name}")
+                self.hoisted += 1
+            node.__dict__.update(Node(NodeType.ND_LVAR, offset=loop.temporaries.get(key, tmp)).__dict__)
+
+        for loop in loops:
+            if len(loop.hoisted) == 0:
+                continue
+            init = loop.hoisted[0]
+            for assign in loop.hoisted[1:]:
+                init = Node(NodeType.ND_COMMA, init, assign)
+            loop.node.init = Node(NodeType.ND_COMMA, init, loop.node.init) if loop.node.init else init
+
+    def run(self) -> list[str]:
+        """ Move the loop-invariant expressions of every function out of their loops
+
+        Returns:
+            list[str]: The report of the hoisted expressions.
+
+        """
+
+        for func in self.parser.functions:
+            self._hoist(func)
+
+        if self.hoisted == 0:
+            return []
+        return self._report + [f"licm: {self.hoisted} expressions hoisted"]
@@ -0,0 +1,182 @@
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from tokenizer import Tokenizer
+from syntax_tree import Parser
+from compiler import Compiler
+from assembler import Assembler, ObjectFile
+from cache import cache_key
+from scheduler import default_machine
+from utils import CompileError
+
+# Masks of the immediate fields patched by each kind of relocation
+RELOCATION_MASKS = {"branch": 0xfe000f80, "jal": 0xfffff000}
+
+
+class Linker():
+    """ Linker class
+
+    This class resolves the symbols of relocatable objects and lays them out into one program image.
+    The object defining main is placed first, so that the program starts at address 0.
+
+    """
+
+    def __init__(self) -> None:
+        pass
+
+    @staticmethod
+    def _patch(word: int, kind: str, offset: int) -> int:
+        if kind == "branch":
+            if not -4096 <= offset < 4096:
+                raise CompileError(f"Branch offset out of range: {offset}")
+            bin = Assembler._b_instruction("zero", "zero", str(offset), "000")
+
+        else:
+            if not -(1 << 20) <= offset < (1 << 20):
+                raise CompileError(f"Jump offset out of range: {offset}")
+            bin = Assembler._j_instruction("zero", str(offset))
+
+        mask = RELOCATION_MASKS[kind]
+        return (word & ~mask) | (int(bin, 2) & mask)
+
+    def link(self, objects: list[ObjectFile]) -> bytes:
+        """ Link the given objects into a program image
+
+        Args:
+            objects (list[ObjectFile]): The objects to link.
+
+        Returns:
+            bytes: The machine code of the whole program.
+
+        """
+
+        entry = [obj for obj in objects if "main" in obj.symbols]
+        if len(entry) == 0:
+            raise CompileError("Undefined symbol: main")
+        objects = entry[:1] + [obj for obj in objects if obj is not entry[0]]
+
+        # Lay the objects out one after another and build the global symbol table
+        bases = []
+        symbols = {}
+        addr = 0
+        for obj in objects:
+            bases.append(addr)
+            for name, offset in obj.symbols.items():
+                if name in symbols:
+                    raise CompileError(f"Duplicate symbol: {name}")
+                symbols[name] = addr + offset
+            addr += len(obj.code)
+
+        image = bytearray()
+        for base, obj in zip(bases, objects):
+            code = bytearray(obj.code)
+            for r in obj.relocations:
+                if r.symbol not in symbols:
+                    raise CompileError(f"Undefined symbol: {r.symbol}")
+
+                word = int.from_bytes(code[r.offset:r.offset+4], byteorder="big")
+                word = Linker._patch(word, r.kind, symbols[r.symbol] - (base + r.offset))
+                code[r.offset:r.offset+4] = word.to_bytes(4, byteorder="big")
+            image += code
+
+        return bytes(image)
+
+
+def compile_unit(src: str, key: str = "") -> ObjectFile:
+    """ Compile one translation unit into a relocatable object
+
+    Args:
+        src (str): The C code.
+        key (str): The content address of the source, recorded in the object.
+
+    Returns:
+        ObjectFile: The relocatable object.
+
+    """
+
+    tokenizer = Tokenizer()
+    tokenizer.tokenize(src)
+    parser = Parser(tokenizer)
+    parser.parse()
+    obj = Assembler().assemble_records(Compiler(parser).generate_records())
+    obj.key = key
+    return obj
+
+
+def _build_unit(job: tuple[str, str, str]) -> str:
+    src_path, obj_path, key = job
+    with open(src_path, "r") as f:
+        obj = compile_unit(f.read(), key)
+    obj.save(obj_path)
+    return obj_path
+
+
+def build(paths: list[str], jobs: int = None) -> tuple[list[ObjectFile], int]:
+    """ Turn C, assembly and object files into objects, compiling C files in parallel
+
+    A C file is compiled into an object next to it, which is reused as long as the
+    source and the toolchain are unchanged.
+
+    Args:
+        paths (list[str]): The .c, .s and .o files of the program.
+        jobs (int): The number of worker processes.
+
+    Returns:
+        tuple[list[ObjectFile], int]: The objects in the given order, and the number of units rebuilt.
+
+    """
+
+    stale = []
+    for path in paths:
+        if not path.endswith(".c"):
+            continue
+
+        with open(path, "r") as f:
+            key = cache_key(f.read(), "obj", {"machine": default_machine().to_dict()})
+
+        obj_path = os.path.splitext(path)[0] + ".o"
+        try:
+            if ObjectFile.load(obj_path).key == key:
+                continue
+        except (OSError, ValueError, KeyError):
+            pass
+        stale.append((path, obj_path, key))
+
+    if len(stale) > 1 and jobs != 1:
+        with ProcessPoolExecutor(max_workers=jobs) as pool:
+            list(pool.map(_build_unit, stale))
+    else:
+        for job in stale:
+            _build_unit(job)
+
+    objects = []
+    for path in paths:
+        if path.endswith(".c"):
+            objects.append(ObjectFile.load(os.path.splitext(path)[0] + ".o"))
+
+        elif path.endswith(".s"):
+            with open(path, "r") as f:
+                objects.append(Assembler().assemble_object(f.read()))
+
+        else:
+            objects.append(ObjectFile.load(path))
+
+    return objects, len(stale)
+
+
+if __name__ == "__main__":
+    args = sys.argv
+    if len(args) < 2:
+        print("The given number of arguments is invalid.", file=sys.stderr)
+        sys.exit(1)
+
+    try:
+        objects, _ = build(args[1:])
+        image = Linker().link(objects)
+
+    except CompileError as e:
+        print(e, file=sys.stderr)
+        sys.exit(1)
+
+    with open("out.bin", "bw") as out:
+        out.write(image)
@@ -0,0 +1,467 @@
+import functools
+import json
+import os
+import re
+from utils import CompileError
+
+DEFAULT_MACHINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "machine.json")
+
+# Indices of the registers each instruction writes and reads (lw and sw are parsed into reg, offset, base)
+OPERANDS = {
+    "add": ([0], [1, 2]), "sub": ([0], [1, 2]), "slt": ([0], [1, 2]), "sltu": ([0], [1, 2]),
+    "xor": ([0], [1, 2]), "or": ([0], [1, 2]), "mul": ([0], [1, 2]), "div": ([0], [1, 2]),
+    "addi": ([0], [1]), "ori": ([0], [1]), "mv": ([0], [1]), "seqz": ([0], [1]), "snez": ([0], [1]),
+    "li": ([0], []), "lui": ([0], []),
+    "lw": ([0], [2]), "sw": ([], [0, 2]),
+}
+CONTROL = {"beqz": ([], [0]), "j": ([], []), "jal": ([0], []), "jalr": ([0], [1]), "ret": ([], [])}
+
+# Registers compiled code only keeps values in within a basic block, so they may be renamed
+SCRATCH = ["t0", "t1", "t2", "t3"]
+
+MEMORY_OPERAND = re.compile(r"^(-?\d+)\((\w+)\)$")
+
+
+class MachineDescription():
+    """ Pipeline model of a build of the CPU
+
+    The latency of an instruction is the number of cycles from its issue until an
+    instruction reading its result can issue without a stall, so 1 means no stall.
+    Instructions issue in order, one per cycle.
+
+    Attributes:
+        name (str): The name of the model.
+        latencies (dict[str, int]): The latency of each opcode class.
+        classes (dict[str, str]): The opcode class of each mnemonic, "alu" for those not listed.
+
+    """
+
+    def __init__(self, name: str, latencies: dict, classes: dict) -> None:
+        self.name = name
+        self.latencies = latencies
+        self.classes = classes
+
+    @staticmethod
+    def load(path: str) -> "MachineDescription":
+        """ Read a machine description file
+
+        Args:
+            path (str): The JSON file with the name, the latency of each class and the mnemonics of each class.
+
+        Returns:
+            MachineDescription: The model.
+
+        """
+
+        try:
+            with open(path, "r") as f:
+                data = json.load(f)
+            latencies = {cls: int(latency) for cls, latency in data["latency"].items()}
+            classes = {mnemonic: cls for cls, mnemonics in data.get("classes", {}).items() for mnemonic in mnemonics}
+        except (OSError, ValueError, KeyError, TypeError, AttributeError) as e:
+            raise CompileError(f"Invalid machine description {path}: {e}")
+
+        if any(latency < 1 for latency in latencies.values()):
+            raise CompileError(f"Invalid machine description {path}: latencies must be at least 1")
+        return MachineDescription(data.get("name", os.path.basename(path)), latencies, classes)
+
+    def to_dict(self) -> dict:
+        classes = {}
+        for mnemonic, cls in sorted(self.classes.items()):
+            classes.setdefault(cls, []).append(mnemonic)
+        return {"name": self.name, "latency": self.latencies, "classes": classes}
+
+    def latency(self, mnemonic: str) -> int:
+        return self.latencies.get(self.classes.get(mnemonic, "alu"), 1)
+
+    def cycles(self, instructions: list["Instruction"]) -> int:
+        """ Estimate the cycles of straight-line code
+
+        Args:
+            instructions (list[Instruction]): The instructions in the order they issue.
+
+        Returns:
+            int: The number of cycles until the last instruction issues, stalls included.
+
+        """
+
+        ready = {}
+        cycle = 0
+        for ins in instructions:
+            for reg in ins.uses():
+                cycle = max(cycle, ready.get(reg, 0))
+            for reg in ins.defs():
+                ready[reg] = cycle + self.latency(ins.mnemonic)
+            cycle += 1
+        return cycle
+
+
+@functools.lru_cache(maxsize=None)
+def _load_machine(path: str) -> MachineDescription:
+    return MachineDescription.load(path)
+
+
+def default_machine() -> MachineDescription:
+    """ Load the machine description named by TC_MACHINE, or the one shipped with the compiler """
+
+    return _load_machine(os.environ.get("TC_MACHINE", DEFAULT_MACHINE))
+
+
+class Instruction():
+    """ One line of assembly code the scheduler understands
+
+    Attributes:
+        mnemonic (str): The mnemonic.
+        operands (list[str]): The operands, with the address of lw and sw split into offset and base.
+        text (str): The line of assembly code, formatted from the operands unless the instruction was parsed.
+        prefix (list[str]): The comment and blank lines preceding the instruction.
+
+    """
+
+    def __init__(self, mnemonic: str, operands: list[str], text: str = None, prefix: list[str] = None) -> None:
+        self.mnemonic = mnemonic
+        self.operands = operands
+        self._text = text
+        self.prefix = prefix or []
+        roles = OPERANDS.get(mnemonic) or CONTROL.get(mnemonic)
+        self._defs = [operands[i] for i in roles[0] if operands[i] not in ("zero", "x0")]
+        self._uses = [operands[i] for i in roles[1] if operands[i] not in ("zero", "x0")]
+
+    @property
+    def text(self) -> str:
+        # Formatted on demand, the assembler takes the instruction as it is
+        if self._text is None:
+            if self.mnemonic in ("lw", "sw"):
+                self._text = f"   {self.mnemonic} {self.operands[0]}, {self.operands[1]}({self.operands[2]})\n"
+            elif len(self.operands) > 0:
+                self._text = f"   {self.mnemonic} {', '.join(self.operands)}\n"
+            else:
+                self._text = f"   {self.mnemonic}\n"
+        return self._text
+
+    @staticmethod
+    def parse(line: str, prefix: list[str] = None):
+        """ Parse a line of assembly code
+
+        Returns:
+            Instruction: The instruction, or None if it is not one the scheduler knows.
+
+        """
+
+        mnemonic, _, rest = line.strip().partition(" ")
+        operands = [op.strip() for op in rest.split(",")] if rest else []
+        if mnemonic in ("lw", "sw"):
+            match = MEMORY_OPERAND.match(operands[-1]) if len(operands) == 2 else None
+            if match is None:
+                return None
+            operands = [operands[0], match.group(1), match.group(2)]
+
+        roles = OPERANDS.get(mnemonic) or CONTROL.get(mnemonic)
+        if roles is None or any(i >= len(operands) for i in roles[0] + roles[1]):
+            return None
+        return Instruction(mnemonic, operands, line, prefix)
+
+    def defs(self) -> list[str]:
+        return self._defs
+
+    def uses(self) -> list[str]:
+        return self._uses
+
+    def renamed(self, operands: list[str]) -> "Instruction":
+        return Instruction(self.mnemonic, operands, prefix=self.prefix)
+
+
+def render(records: list) -> str:
+    """ Format code given as Instruction records and lines of assembly code """
+
+    return "".join(record if isinstance(record, str) else record.text for record in records)
+
+
+class Scheduler():
+    """ List scheduler for the basic blocks of compiled code
+
+    Every basic block is scheduled in windows of at most `window` instructions. The
+    scratch registers are renamed first, round-robin, so that the reuse of t0 and t1 by
+    the stack machine code does not serialize independent computations. Within a window
+    instructions are ordered by their dependences on registers and memory, and among
+    the instructions ready in a cycle the one heading the longest chain of latencies
+    issues first. A block keeps its original order unless the new one is estimated to
+    be faster on the machine. The comments of the compiler describe the code in its
+    original order, so a reordered block keeps only its blank lines.
+
+    Addresses are followed symbolically from the registers at the start of the block.
+    Two addresses with the same root and offsets 4 bytes apart or more do not alias,
+    and neither do an address into the temporaries above the stack pointer and one into
+    the frame below fp or t6, which compiled code never mixes. Like the renaming of the
+    scratch registers, which are dead between basic blocks, this relies on the code
+    being produced by Compiler.generate.
+
+    Attributes:
+        machine (MachineDescription): The pipeline model to schedule for.
+        window (int): The most instructions reordered together.
+        before (int): The estimated cycles of all blocks in the original order.
+        after (int): The estimated cycles of all blocks as scheduled.
+
+    """
+
+    def __init__(self, machine: MachineDescription, window: int = 64) -> None:
+        self.machine = machine
+        self.window = window
+        self.before = 0
+        self.after = 0
+
+    def _rename(self, block: list[Instruction]) -> list[Instruction]:
+        # Position of the last read of the value each instruction writes, and of the values live on entry
+        last_read = {}
+        writer = {reg: -1 for reg in SCRATCH}
+        for i, ins in enumerate(block):
+            for reg in ins.uses():
+                if reg in writer:
+                    last_read[(writer[reg], reg)] = i
+            for reg in ins.defs():
+                if reg in writer:
+                    writer[reg] = i
+
+        busy = {reg: last_read.get((-1, reg), -1) for reg in SCRATCH}     # Last read of the value held
+        freed = {reg: busy[reg] for reg in SCRATCH}
+        mapping = {reg: reg for reg in SCRATCH}
+        renamed = []
+        for i, ins in enumerate(block):
+            roles = OPERANDS.get(ins.mnemonic) or CONTROL.get(ins.mnemonic)
+            operands = list(ins.operands)
+            for j in roles[1]:
+                operands[j] = mapping.get(operands[j], operands[j])
+            for j in roles[0]:
+                reg = ins.operands[j]
+                if reg not in mapping:
+                    continue
+                # A register read last by this instruction is free to receive its result
+                free = [p for p in SCRATCH if busy[p] <= i]
+                phys = min(free, key=lambda p: (freed[p], p != reg))
+                busy[phys] = freed[phys] = last_read.get((i, reg), i)
+                mapping[reg] = phys
+                operands[j] = phys
+            renamed.append(ins.renamed(operands) if operands != ins.operands else ins)
+        return renamed
+
+    def _addresses(self, block: list[Instruction]) -> list:
+        """ Follow the addresses of the memory accesses symbolically
+
+        Returns:
+            list: The address of each instruction as (root, offset), or None for instructions not accessing memory.
+
+        """
+
+        values = {}
+        memory = {}     # The value stored at each offset from each root
+        addresses = []
+
+        def value(reg):
+            return values.get(reg, (("entry", reg), 0))
+
+        for i, ins in enumerate(block):
+            ops = ins.operands
+            address = None
+            result = (("value", i), 0)
+            if ins.mnemonic in ("lw", "sw"):
+                root, offset = value(ops[2])
+                address = (root, offset + int(ops[1]))
+                if ins.mnemonic == "lw":
+                    result = memory.get(root, {}).get(address[1], result)
+                else:
+                    # Forget the values of the words the store may overwrite
+                    for other in list(memory):
+                        if other == root:
+                            for offset in range(address[1] - 3, address[1] + 4):
+                                memory[root].pop(offset, None)
+                        elif Scheduler._may_alias((other, 0), (root, 0)):
+                            del memory[other]
+                    memory.setdefault(root, {})[address[1]] = value(ops[0])
+            elif ins.mnemonic == "li":
+                result = (None, int(ops[1]))
+            elif ins.mnemonic == "addi":
+                root, offset = value(ops[1])
+                result = (root, offset + int(ops[2]))
+            elif ins.mnemonic == "mv":
+                result = value(ops[1])
+            elif ins.mnemonic in ("add", "sub"):
+                (root1, offset1), (root2, offset2) = value(ops[1]), value(ops[2])
+                if root2 is None:
+                    result = (root1, offset1 + offset2 if ins.mnemonic == "add" else offset1 - offset2)
+                elif root1 is None and ins.mnemonic == "add":
+                    result = (root2, offset1 + offset2)
+
+            for reg in ins.defs():
+                values[reg] = result
+            addresses.append(address)
+        return addresses
+
+    @staticmethod
+    def _may_alias(a: tuple, b: tuple) -> bool:
+        if a[0] == b[0]:
+            return abs(a[1] - b[1]) < 4
+        regions = {a[0], b[0]}
+        if ("entry", "sp") in regions and (("entry", "fp") in regions or ("entry", "t6") in regions):
+            return False
+        return True
+
+    def _order(self, window: list[Instruction], addresses: list) -> list[Instruction]:
+        n = len(window)
+        succs = [[] for _ in range(n)]
+        preds = [0] * n
+
+        def edge(src, dst, latency):
+            succs[src].append((dst, latency))
+            preds[dst] += 1
+
+        latencies = [self.machine.latency(ins.mnemonic) for ins in window]
+        last_write = {}
+        reads = {}
+        loads = []
+        stores = []
+        for i, ins in enumerate(window):
+            for reg in ins.uses():
+                if reg in last_write:
+                    edge(last_write[reg], i, latencies[last_write[reg]])
+            for reg in ins.defs():
+                if reg in last_write:
+                    edge(last_write[reg], i, 0)
+                for j in reads.get(reg, []):
+                    edge(j, i, 0)
+            for reg in ins.uses():
+                reads.setdefault(reg, []).append(i)
+            for reg in ins.defs():
+                last_write[reg] = i
+                reads[reg] = []
+
+            # Loads wait for the stores before them, stores for every access before them
+            if addresses[i] is not None:
+                store = ins.mnemonic == "sw"
+                for j in stores:
+                    if Scheduler._may_alias(addresses[i], addresses[j]):
+                        edge(j, i, 0 if store else latencies[j])
+                if store:
+                    for j in loads:
+                        if Scheduler._may_alias(addresses[i], addresses[j]):
+                            edge(j, i, 0)
+                (stores if store else loads).append(i)
+
+        # Priority: the longest chain of latencies from an instruction to the end of the window
+        height = [1] * n
+        for i in range(n - 1, -1, -1):
+            for j, latency in succs[i]:
+                height[i] = max(height[i], max(latency, 1) + height[j])
+
+        earliest = [0] * n
+        ready = [i for i in range(n) if preds[i] == 0]
+        order = []
+        cycle = 0
+        while len(ready) > 0:
+            issuable = [i for i in ready if earliest[i] <= cycle]
+            if len(issuable) == 0:
+                cycle = min(earliest[i] for i in ready)
+                continue
+
+            i = max(issuable, key=lambda i: (height[i], -i))
+            ready.remove(i)
+            order.append(window[i])
+            for j, latency in succs[i]:
+                earliest[j] = max(earliest[j], cycle + latency)
+                preds[j] -= 1
+                if preds[j] == 0:
+                    ready.append(j)
+            cycle += 1
+        return order
+
+    def _schedule_block(self, block: list[Instruction]) -> list:
+        if len(block) == 0:
+            return []
+
+        original = [record for ins in block for record in ins.prefix + [ins]]
+        before = self.machine.cycles(block)
+        self.before += before
+        if before == len(block):
+            # Nothing stalls, so no order can be faster
+            self.after += before
+            return original
+
+        terminator = block[-1:] if block[-1].mnemonic in CONTROL else []
+        renamed = self._rename(block)
+        body = renamed[:len(renamed) - len(terminator)]
+        addresses = self._addresses(body)
+
+        scheduled = []
+        for start in range(0, len(body), self.window):
+            scheduled += self._order(body[start:start + self.window], addresses[start:start + self.window])
+        scheduled += renamed[len(body):]
+
+        after = self.machine.cycles(scheduled)
+        if after >= before:
+            self.after += before
+            return original
+
+        self.after += after
+        return [record for ins in scheduled for record in [line for line in ins.prefix if line.strip() == ""] + [ins]]
+
+    def schedule(self, asm: str) -> str:
+        """ Reorder the instructions of every basic block of the given assembly code
+
+        Args:
+            asm (str): The assembly code generated by the compiler.
+
+        Returns:
+            str: The scheduled assembly code.
+
+        """
+
+        records = []
+        for line in asm.splitlines(keepends=True):
+            stripped = line.strip()
+            ins = None
+            if stripped != "" and not stripped.startswith("#") and not stripped.endswith(":"):
+                ins = Instruction.parse(line)
+            records.append(line if ins is None else ins)
+        return render(self.schedule_records(records))
+
+    def schedule_records(self, records: list) -> list:
+        """ Reorder the instructions of every basic block of the given code
+
+        The comment and blank lines preceding an instruction become its prefix.
+
+        Args:
+            records (list): The code generated by the compiler, with the instructions as
+                Instruction and the other lines as str.
+
+        Returns:
+            list: The scheduled code, with the instructions as Instruction and the other lines as str.
+
+        """
+
+        out = []
+        block = []
+        prefix = []
+        for record in records:
+            if isinstance(record, str):
+                stripped = record.strip()
+                if stripped == "" or stripped.startswith("#"):
+                    prefix.append(record)
+                    continue
+
+                # Labels and instructions the scheduler does not know stay where they are
+                out += self._schedule_block(block) + prefix + [record]
+                block = []
+                prefix = []
+                continue
+
+            record.prefix = prefix
+            prefix = []
+            block.append(record)
+            if record.mnemonic in CONTROL:
+                out += self._schedule_block(block)
+                block = []
+
+        out += self._schedule_block(block) + prefix
+        return out
+
+    def report(self) -> str:
+        return f"scheduling for {self.machine.name}: cycles {self.before} -> {self.after} (estimated, straight-line)"
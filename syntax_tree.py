@@ -1,5 +1,7 @@
+import copy
 from enum import Enum
-from tokenizer import Tokenizer
+from tokenizer import Tokenizer, TokenType
+from utils import CompileError
 
 class NodeType(Enum):
     ND_ADD = 0      # +
@@ -17,10 +19,12 @@ class NodeType(Enum):
     ND_IF = 12      # if
     ND_FOR = 13     # for
     ND_BLOCK = 14   # Compound statements (block)
+    ND_FUNCALL = 15 # Function call
+    ND_COMMA = 16   # Comma expression (introduced by the inliner)
 
 class Node():
     def __init__(self, type, lhs = None, rhs = None, val = None, offset = None, cond = None, 
-                 then = None, els = None, labels = None, init = None, inc = None) -> None:
+                 then = None, els = None, labels = None, init = None, inc = None, name = None, args = None) -> None:
         self.node_type = type
         self.lhs = lhs
         self.rhs = rhs
@@ -33,6 +37,106 @@ class Node():
         self.inc = inc
         self.labels = labels
         self.block = None
+        self.name = name
+        self.args = args
+
+def walk(node: Node):
+    """ Iterate over the nodes of the given tree in pre-order without recursion """
+
+    stack = [node]
+    while len(stack) > 0:
+        node = stack.pop()
+        if node is None:
+            continue
+        yield node
+        stack += (node.args or [])[::-1]
+        stack += (node.block or [])[::-1]
+        stack += [node.inc, node.els, node.then, node.cond, node.init, node.rhs, node.lhs]
+
+NODE_CHILDREN = ("lhs", "rhs", "cond", "then", "els", "init", "inc")
+
+def clone(root: Node) -> Node:
+    """ Copy the given tree without recursion """
+
+    copies = {}
+    for node in walk(root):
+        copies[id(node)] = Node.__new__(Node)
+        copies[id(node)].__dict__.update(node.__dict__)
+
+    for node in copies.values():
+        for attr in NODE_CHILDREN:
+            child = getattr(node, attr)
+            if child is not None:
+                setattr(node, attr, copies[id(child)])
+        if node.block is not None:
+            node.block = [copies[id(child)] for child in node.block]
+        if node.args is not None:
+            node.args = [copies[id(child)] for child in node.args]
+        if node.labels is not None:
+            node.labels = list(node.labels)
+    return copies[id(root)]
+
+NODE_FIELDS = ("node_type", "val", "offset", "labels", "name") + NODE_CHILDREN + ("block", "args")
+
+def flatten(roots: list[Node]) -> tuple[list[tuple], list[int]]:
+    """ Turn the given trees into a table of nodes referring to each other by index
+
+    Returns:
+        tuple[list[tuple], list[int]]: The fields of every node, and the indices of the roots.
+
+    """
+
+    index = {}
+    nodes = []
+    for root in roots:
+        if id(root) in index:
+            continue
+        for node in walk(root):
+            index[id(node)] = len(nodes)
+            nodes.append(node)
+
+    rows = []
+    for node in nodes:
+        row = [getattr(node, attr) for attr in NODE_FIELDS]
+        for i, attr in enumerate(NODE_FIELDS):
+            if attr in NODE_CHILDREN and row[i] is not None:
+                row[i] = index[id(row[i])]
+            elif attr in ("block", "args") and row[i] is not None:
+                row[i] = [index[id(child)] for child in row[i]]
+        rows.append(tuple(row))
+    return rows, [index[id(root)] for root in roots]
+
+def unflatten(rows: list[tuple]) -> list[Node]:
+    """ Rebuild the nodes flattened by flatten, in the order of the table """
+
+    nodes = [Node.__new__(Node) for _ in rows]
+    for node, row in zip(nodes, rows):
+        for attr, val in zip(NODE_FIELDS, row):
+            if attr in NODE_CHILDREN and val is not None:
+                val = nodes[val]
+            elif attr in ("block", "args") and val is not None:
+                val = [nodes[i] for i in val]
+            setattr(node, attr, val)
+    return nodes
+
+class Function():
+    """ Function definition
+
+    Attributes:
+        name (str): The name of the function.
+        params (list[int]): The offsets of the parameters, in the order of a0-a7.
+        code (list[Node]): The statements of the body.
+        l_vars (list[str]): The names of the local variables (parameters included).
+        lvar_offsets (list[int]): The offsets of the local variables from the frame base.
+
+    """
+
+    def __init__(self, name: str, params: list[int], code: list[Node], l_vars: list[str], lvar_offsets: list[int]) -> None:
+        self.name = name
+        self.params = params
+        self.code = code
+        self.l_vars = l_vars
+        self.lvar_offsets = lvar_offsets
 
 class Parser():
     def __init__(self, tokenizer: Tokenizer) -> None:
@@ -41,8 +145,38 @@ class Parser():
         self.l_vars: list[str] = ["0"]  # Initialize with null variable (for some convenience)
         self.lvar_offsets: list[int] = [0]
         self.labels: list[str] = []
+        self.functions: list[Function] = []
+
+    def __getstate__(self) -> dict:
+        # Pickle the syntax trees as flat tables, so that deeply nested ones do not exhaust the Python stack
+        state = dict(self.__dict__)
+        roots = self.code + [stmt for func in self.functions for stmt in func.code]
+        state["nodes"], refs = flatten(roots)
+
+        state["code"] = refs[:len(self.code)]
+        state["functions"] = []
+        start = len(self.code)
+        for func in self.functions:
+            func = copy.copy(func)
+            func.code, start = refs[start:start + len(func.code)], start + len(func.code)
+            state["functions"].append(func)
+        return state
+
+    def __setstate__(self, state: dict) -> None:
+        nodes = unflatten(state.pop("nodes"))
+        self.__dict__.update(state)
+        self.code = [nodes[i] for i in self.code]
+        for func in self.functions:
+            func.code = [nodes[i] for i in func.code]
     
-    def _stmt(self) -> Node:
+    def _stmt_head(self):
+        """ Parse the part of a statement that precedes its sub-statements
+
+        Returns:
+            tuple[Node, bool]: The statement, and whether it still waits for a sub-statement.
+
+        """
+
         if self.tokenizer.consume("return"):
             node = Node(NodeType.ND_RETURN, self._expr())
         
@@ -51,14 +185,7 @@ class Parser():
             node = Node(NodeType.ND_IF, cond=self._expr(), labels=[f".Lend{len(self.labels):03}"])
             self.labels.append(node.labels[0])
             self.tokenizer.expect(")")
-            node.then = self._stmt()
-
-            if self.tokenizer.consume("else"):
-                node.els = self._stmt()
-                node.labels.append(f".Lelse{(len(self.labels) - 1):03}")
-                self.labels.append(node.labels[1])
-
-            return node
+            return node, True
         
         elif self.tokenizer.consume("for"):
             self.tokenizer.expect("(")
@@ -81,8 +208,7 @@ class Parser():
                 node.inc = self._expr()
                 self.tokenizer.expect(")")
             
-            node.then = self._stmt()
-            return node
+            return node, True
         
         elif self.tokenizer.consume("while"):
             self.tokenizer.expect("(")
@@ -95,127 +221,250 @@ class Parser():
 
             node.cond = self._expr()
             self.tokenizer.expect(")")
-            node.then = self._stmt()
-            return node
+            return node, True
         
         elif self.tokenizer.consume("{"):
             node = Node(NodeType.ND_BLOCK)
             node.block = []
-            while not self.tokenizer.consume("}"):
-                node.block.append(self._stmt())
-            return node
+            return node, not self.tokenizer.consume("}")
             
         else:
             node = self._expr()
         self.tokenizer.expect(";")
-        return node
-    
-    def _expr(self) -> Node:
-        return self._assign()
-    
-    def _assign(self) -> Node:
-        node = self._equality()
-        if self.tokenizer.consume("="):
-            node = Node(NodeType.ND_ASSIGN, node, self._assign())
-        
-        return node
-    
-    def _equality(self) -> Node:
-        node = self._relational()
+        return node, False
 
-        while True:
-            if self.tokenizer.consume("=="):
-                node = Node(NodeType.ND_EQ, node, self._relational())
+    def _stmt(self) -> Node:
+        """ Parse a statement
 
-            elif self.tokenizer.consume("!="):
-                node = Node(NodeType.ND_NEQ, node, self._relational())
-                
-            else:
-                break
-        
-        return node
-    
-    def _relational(self) -> Node:
-        node = self._add()
+        Nested statements are parsed with an explicit stack of the enclosing statements
+        instead of recursion, so that the nesting depth is not limited by the Python stack.
+
+        Returns:
+            Node: The statement.
+
+        """
 
+        parents = []    # Enclosing statements waiting for a sub-statement
         while True:
-            if self.tokenizer.consume("<"):
-                node = Node(NodeType.ND_LT, node, self._add())
+            node, incomplete = self._stmt_head()
+            if incomplete:
+                parents.append(node)
+                continue
 
-            elif self.tokenizer.consume("<="):
-                node = Node(NodeType.ND_LE, node, self._add())
+            # Hand the finished statement to the enclosing ones, as long as they are complete as well
+            while len(parents) > 0:
+                parent = parents[-1]
+                if parent.node_type == NodeType.ND_BLOCK:
+                    parent.block.append(node)
+                    if not self.tokenizer.consume("}"):
+                        break
 
-            elif self.tokenizer.consume(">"):
-                node = Node(NodeType.ND_LT, self._add(), node)
+                elif parent.node_type == NodeType.ND_IF and parent.then is None:
+                    parent.then = node
+                    if self.tokenizer.consume("else"):
+                        break
 
-            elif self.tokenizer.consume(">="):
-                node = Node(NodeType.ND_LE, self._add(), node)
+                elif parent.node_type == NodeType.ND_IF:
+                    parent.els = node
+                    parent.labels.append(f".Lelse{(len(self.labels) - 1):03}")
+                    self.labels.append(parent.labels[1])
 
-            else:
-                break
-        
-        return node
+                else:
+                    parent.then = node
+
+                node = parents.pop()
+
+            if len(parents) == 0:
+                return node
     
-    def _add(self) -> Node:
-        node = self._mul()
+    # Binary operators: precedence, node type and whether the operands are swapped
+    BINARY_OPS = {
+        "=": (1, NodeType.ND_ASSIGN, False),
+        "==": (2, NodeType.ND_EQ, False),
+        "!=": (2, NodeType.ND_NEQ, False),
+        "<": (3, NodeType.ND_LT, False),
+        "<=": (3, NodeType.ND_LE, False),
+        ">": (3, NodeType.ND_LT, True),
+        ">=": (3, NodeType.ND_LE, True),
+        "+": (4, NodeType.ND_ADD, False),
+        "-": (4, NodeType.ND_SUB, False),
+        "*": (5, NodeType.ND_MUL, False),
+        "/": (5, NodeType.ND_DIV, False),
+    }
+    UNARY_PREC = 6
 
-        while True:
-            if self.tokenizer.consume("+"):
-                node = Node(NodeType.ND_ADD, node, self._mul())
+    def _expr(self) -> Node:
+        """ Parse an expression by precedence climbing
 
-            elif self.tokenizer.consume("-"):
-                node = Node(NodeType.ND_SUB, node, self._mul())
+        Operators and open parentheses or calls wait on an explicit stack until an
+        operator of lower precedence, a closing parenthesis or the end of the expression
+        reduces them. Only "=" is right-associative. The nesting depth is therefore
+        not limited by the Python stack, and each token is handled in constant time.
 
-            else:
-                break
-        
-        return node
+        Returns:
+            Node: The expression.
+
+        """
 
-    def _mul(self) -> Node:
-        node = self._unary()
+        operands: list[Node] = []
+        ops: list[tuple] = []   # ("binary", op), ("unary", op), ("paren",) or ("call", node, index of the first argument)
+        groups = 0              # Number of open parentheses and calls in ops
 
+        def _reduce() -> None:
+            op = ops.pop()
+            if op[0] == "unary":
+                if op[1] == "-":
+                    operands.append(Node(NodeType.ND_SUB, Node(NodeType.ND_NUM, val=0), operands.pop()))
+                return
+
+            _, node_type, swap = Parser.BINARY_OPS[op[1]]
+            rhs = operands.pop()
+            lhs = operands.pop()
+            operands.append(Node(node_type, rhs, lhs) if swap else Node(node_type, lhs, rhs))
+
+        def _reduce_group() -> tuple:
+            while ops[-1][0] in ("binary", "unary"):
+                _reduce()
+            return ops[-1]
+
+        expect_operand = True
         while True:
-            if self.tokenizer.consume("*"):
-                node = Node(NodeType.ND_MUL, node, self._unary())
+            if expect_operand:
+                if self.tokenizer.consume("+"):
+                    ops.append(("unary", "+"))
+                    continue
+
+                elif self.tokenizer.consume("-"):
+                    ops.append(("unary", "-"))
+                    continue
+
+                elif self.tokenizer.consume("("):
+                    ops.append(("paren",))
+                    groups += 1
+                    continue
 
-            elif self.tokenizer.consume("/"):
-                node = Node(NodeType.ND_DIV, node, self._unary())
+                tok = self.tokenizer.consume_ident()
+                if tok and self.tokenizer.consume("("):
+                    node = Node(NodeType.ND_FUNCALL, name=tok.token_str, args=[])
+                    if not self.tokenizer.consume(")"):
+                        ops.append(("call", node, len(operands)))
+                        groups += 1
+                        continue
+                    operands.append(node)
+
+                elif tok:
+                    operands.append(Node(NodeType.ND_LVAR, offset=self._lvar_offset(tok.token_str)))
+
+                else:
+                    operands.append(Node(NodeType.ND_NUM, val=self.tokenizer.expect_number()))
+
+                expect_operand = False
+                continue
+
+            tok = self.tokenizer.peek()
+            if tok.type == TokenType.TK_RESERVED and tok.token_str in Parser.BINARY_OPS:
+                self.tokenizer.consume(tok.token_str)
+                prec = Parser.BINARY_OPS[tok.token_str][0]
+                right_assoc = tok.token_str == "="
+                while len(ops) > 0 and ops[-1][0] in ("binary", "unary"):
+                    top_prec = Parser.UNARY_PREC if ops[-1][0] == "unary" else Parser.BINARY_OPS[ops[-1][1]][0]
+                    if top_prec < prec or (top_prec == prec and right_assoc):
+                        break
+                    _reduce()
+                ops.append(("binary", tok.token_str))
+                expect_operand = True
+
+            elif tok.token_str == ")" and groups > 0:
+                self.tokenizer.consume(")")
+                group = _reduce_group()
+                ops.pop()
+                groups -= 1
+                if group[0] == "call":
+                    node, first = group[1], group[2]
+                    node.args = operands[first:]
+                    del operands[first:]
+                    if len(node.args) > 8:
+                        raise CompileError(f"Too many arguments to {node.name}: at most 8 are passed in a0-a7.")
+                    operands.append(node)
+
+            elif tok.token_str == "," and groups > 0 and _reduce_group()[0] == "call":
+                self.tokenizer.consume(",")
+                expect_operand = True
 
             else:
                 break
-        
-        return node
-    
-    def _unary(self) -> Node:
-        if self.tokenizer.consume("+"):
-            return self._primary()
-        
-        elif self.tokenizer.consume("-"):
-            return Node(NodeType.ND_SUB, Node(NodeType.ND_NUM, val=0), self._primary())
-        
-        else:
-            return self._primary()
-    
-    def _primary(self) -> Node:
-        tok = self.tokenizer.consume_ident()
-        if tok:
-            if tok.token_str not in self.l_vars:
-                tail_offset = self.lvar_offsets[-1]
-                self.l_vars.append(tok.token_str)
-                self.lvar_offsets.append(tail_offset + 4)
-
-            offset = self.lvar_offsets[self.l_vars.index(tok.token_str)]
-            return Node(NodeType.ND_LVAR, offset=offset)
-        
-        elif self.tokenizer.consume("("):
-            node = self._expr()
-            self.tokenizer.expect(")")
-            return node
-        
-        else:
-            return Node(NodeType.ND_NUM, val=self.tokenizer.expect_number())
-    
+
+        if groups > 0:
+            self.tokenizer.expect(")")     # Reports the missing parenthesis
+
+        while len(ops) > 0:
+            _reduce()
+        return operands[0]
+
+    def _lvar_offset(self, name: str) -> int:
+        if name not in self.l_vars:
+            tail_offset = self.lvar_offsets[-1]
+            self.l_vars.append(name)
+            self.lvar_offsets.append(tail_offset + 4)
+
+        return self.lvar_offsets[self.l_vars.index(name)]
+
+    def _is_funcdef(self) -> bool:
+        # ident "(" (ident ("," ident)*)? ")" "{"
+        peek = self.tokenizer.peek
+        if peek().type != TokenType.TK_IDENT or peek(1).token_str != "(":
+            return False
+
+        i = 2
+        while peek(i).type == TokenType.TK_IDENT or peek(i).token_str == ",":
+            i += 1
+        return peek(i).token_str == ")" and peek(i+1).token_str == "{"
+
+    def _funcdef(self) -> Function:
+        name = self.tokenizer.consume_ident().token_str
+        self.tokenizer.expect("(")
+
+        # Each function gets its own local variables, the top-level ones are restored afterwards
+        top_l_vars, top_lvar_offsets = self.l_vars, self.lvar_offsets
+        self.l_vars, self.lvar_offsets = ["0"], [0]
+
+        params = []
+        while not self.tokenizer.consume(")"):
+            if len(params) > 0:
+                self.tokenizer.expect(",")
+            tok = self.tokenizer.consume_ident()
+            if tok is None:
+                raise CompileError(f"Expected a parameter name but got {self.tokenizer.peek().token_str}.")
+            param = tok.token_str
+            if param in self.l_vars:
+                raise CompileError(f"Duplicate parameter {param} of {name}.")
+            params.append(self._lvar_offset(param))
+
+        if len(params) > 8:
+            raise CompileError(f"Too many parameters of {name}: at most 8 are passed in a0-a7.")
+
+        self.tokenizer.expect("{")
+        code = []
+        while not self.tokenizer.consume("}"):
+            code.append(self._stmt())
+
+        func = Function(name, params, code, self.l_vars, self.lvar_offsets)
+        self.l_vars, self.lvar_offsets = top_l_vars, top_lvar_offsets
+        return func
+
     def parse(self) -> None:
         while not self.tokenizer.at_eof():
-            self.code.append(self._stmt())
+            if self._is_funcdef():
+                func = self._funcdef()
+                if func.name in [f.name for f in self.functions]:
+                    raise CompileError(f"Redefinition of {func.name}.")
+                self.functions.append(func)
+            else:
+                self.code.append(self._stmt())
+
+        # Top-level statements make up the body of an implicit main
+        if len(self.code) > 0:
+            if "main" in [f.name for f in self.functions]:
+                raise CompileError("Top-level statements conflict with the definition of main.")
+            self.functions.insert(0, Function("main", [], self.code, self.l_vars, self.lvar_offsets))
         
\ No newline at end of file
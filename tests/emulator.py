@@ -0,0 +1,86 @@
+from tokenizer import Tokenizer
+from syntax_tree import Parser
+from compiler import Compiler
+from assembler import Assembler
+
+
+def _signed(value: int, bits: int) -> int:
+    value &= (1 << bits) - 1
+    return value - (1 << bits) if value >> (bits - 1) else value
+
+
+def run(binary: bytes, max_steps: int = 1_000_000) -> int:
+    """ Run a program on a minimal RV32IM interpreter covering what the assembler emits
+
+    Args:
+        binary (bytes): The machine code, starting at address 0.
+        max_steps (int): The most instructions to execute.
+
+    Returns:
+        int: The value of a0 once the program jumps to itself.
+
+    """
+
+    words = [int.from_bytes(binary[i:i + 4], "big") for i in range(0, len(binary), 4)]
+    regs = [0] * 32
+    memory = {}
+    pc = 0
+    for _ in range(max_steps):
+        ins = words[pc // 4]
+        opcode, rd, funct3 = ins & 0x7f, (ins >> 7) & 31, (ins >> 12) & 7
+        a, b = _signed(regs[(ins >> 15) & 31], 32), _signed(regs[(ins >> 20) & 31], 32)
+        result = None
+        next_pc = pc + 4
+
+        if opcode == 0x33:
+            funct7 = ins >> 25
+            if funct7 == 1:
+                result = {0: lambda: a * b, 4: lambda: int(a / b) if b else -1}[funct3]()
+            else:
+                result = {0: a - b if funct7 == 0x20 else a + b, 2: int(a < b),
+                          3: int(a % (1 << 32) < b % (1 << 32)), 4: a ^ b, 6: a | b}[funct3]
+        elif opcode == 0x13:
+            imm = _signed(ins >> 20, 12)
+            result = {0: a + imm, 3: int(a % (1 << 32) < imm % (1 << 32)), 6: a | imm}[funct3]
+        elif opcode == 0x03:
+            result = memory.get((a + _signed(ins >> 20, 12)) % (1 << 32), 0)
+        elif opcode == 0x23:
+            imm = _signed(((ins >> 25) << 5) | ((ins >> 7) & 31), 12)
+            memory[(a + imm) % (1 << 32)] = b
+        elif opcode == 0x37:
+            result = ins & 0xfffff000
+        elif opcode == 0x63:
+            imm = _signed(((ins >> 31) << 12) | (((ins >> 7) & 1) << 11) | (((ins >> 25) & 0x3f) << 5)
+                          | (((ins >> 8) & 0xf) << 1), 13)
+            if (a == b) == (funct3 == 0):
+                next_pc = pc + imm
+        elif opcode == 0x6f:
+            imm = _signed(((ins >> 31) << 20) | (((ins >> 12) & 0xff) << 12) | (((ins >> 20) & 1) << 11)
+                          | (((ins >> 21) & 0x3ff) << 1), 21)
+            result, next_pc = pc + 4, pc + imm
+        elif opcode == 0x67:
+            result, next_pc = pc + 4, (a + _signed(ins >> 20, 12)) & ~1
+        else:
+            raise ValueError(f"Unknown opcode {opcode:#x} at {pc}")
+
+        if result is not None and rd != 0:
+            regs[rd] = result % (1 << 32)
+        if next_pc == pc:
+            return _signed(regs[10], 32)
+        pc = next_pc
+    raise RuntimeError("The program did not halt")
+
+
+def compile_and_run(src: str, **options) -> int:
+    """ Compile C code with the given Compiler options and run it
+
+    Returns:
+        int: The value the program leaves in a0.
+
+    """
+
+    tokenizer = Tokenizer()
+    tokenizer.tokenize(src)
+    parser = Parser(tokenizer)
+    parser.parse()
+    return run(Assembler().assemble_source(Compiler(parser, **options).generate()))
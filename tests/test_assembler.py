@@ -0,0 +1,10 @@
+import pytest
+from assembler import Assembler
+
+
+@pytest.mark.parametrize("short, full", [
+    ("   lw t0, (sp)\n", "   lw t0, 0(sp)\n"),
+    ("   sw t1,(t0)\n", "   sw t1, 0(t0)\n"),
+])
+def test_memory_offset_defaults_to_zero(short, full):
+    assert Assembler().assemble_source(short) == Assembler().assemble_source(full)
@@ -0,0 +1,12 @@
+from batch import BatchCompiler
+
+
+def test_units_without_main_fail(tmp_path):
+    (tmp_path / "lib.c").write_text("sq(x) { return x * x; }")
+    (tmp_path / "main.c").write_text("main() { return 3; }")
+
+    results = BatchCompiler(jobs=1, out_dir=str(tmp_path / "out")).run(str(tmp_path), [str(tmp_path / "lib.c"), str(tmp_path / "main.c")])
+    assert [r.ok for r in results] == [False, True]
+    assert "main" in results[0].error
+    assert not (tmp_path / "out" / "lib.bin").exists()
+    assert (tmp_path / "out" / "main.bin").exists()
@@ -0,0 +1,35 @@
+import os
+from concurrent.futures import ProcessPoolExecutor
+from tokenizer import Tokenizer
+from syntax_tree import Parser
+from compiler import Compiler
+from cache import Artifacts, DiskCache, run_pipeline
+
+
+def _store(job: tuple[str, int]) -> None:
+    cache_dir, worker = job
+    cache = DiskCache(cache_dir, max_bytes=40000)
+    for i in range(200):
+        cache.put(f"{worker:02x}{i:062x}", Artifacts(asm="x" * 500))
+
+
+def test_processes_sharing_a_directory_keep_its_limit(tmp_path):
+    with ProcessPoolExecutor(max_workers=4) as pool:
+        list(pool.map(_store, [(str(tmp_path), worker) for worker in range(4)]))
+
+    total = sum(os.path.getsize(os.path.join(root, name))
+                for root, _, files in os.walk(tmp_path) for name in files if name.endswith(".pkl"))
+    assert 0 < total <= 40000
+    assert DiskCache(str(tmp_path), max_bytes=40000).total == total
+
+
+def test_the_cached_syntax_tree_is_the_parsed_one():
+    src = "sq(x) { return x * x; } main() { s = 0; for (i = 0; i < 3; i = i + 1) s = s + sq(i) * (i + 1) * (i + 1); return s; }"
+    tokenizer = Tokenizer()
+    tokenizer.tokenize(src)
+    parser = Parser(tokenizer)
+    parser.parse()
+
+    artifacts = run_pipeline(src)
+    assert [func.l_vars for func in artifacts.parser.functions] == [func.l_vars for func in parser.functions]
+    assert Compiler(artifacts.parser, optimize=False).generate() == Compiler(parser, optimize=False).generate()
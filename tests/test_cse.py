@@ -0,0 +1,22 @@
+import pytest
+from emulator import compile_and_run
+
+# Programs whose value is whatever the last expression statement left in a0
+PROGRAMS = [
+    # Repeated subexpressions, reused
+    "a = 6; b = 2; x = (a - b) * (a - b) + (a - b); x;",
+    "a = 3; b = 5; x = a * b + 1; c = 2; y = a * b + 1; x * 100 + y + c;",
+    # A repeated subexpression across an assignment to one of its operands
+    "a = 3; b = 5; x = a * b + 1; a = a + 1; y = a * b + 1; x * 100 + y;",
+    "main() { a = 3; b = 5; { x = a * b + 1; a = a + 1; y = a * b + 1; } return x * 100 + y; }",
+    "a = 6; b = 2; x = (a - b) * (a - b) + (a - b); b = (a - b) * 2; x * 1000 + b + (a - b);",
+    "a = 6; b = 2; x = (a - b) + (b = 5) + (a - b); x;",
+    # Across control flow
+    "a = 3; b = 5; x = a * b; if (x == 15) a = 1; y = a * b; x * 100 + y;",
+    "a = 3; s = 0; for (i = 0; i < 4; i = i + 1) { s = s + a * 2; a = a + 1; s = s + a * 2; } s;",
+]
+
+
+@pytest.mark.parametrize("src", PROGRAMS)
+def test_reused_subexpressions_keep_the_result(src):
+    assert compile_and_run(src) == compile_and_run(src, optimize=False)
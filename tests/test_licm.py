@@ -0,0 +1,27 @@
+import pytest
+from emulator import compile_and_run
+
+# Programs whose value is whatever the last expression statement left in a0
+PROGRAMS = [
+    # Invariant expressions, hoisted
+    "n = 7; s = 0; for (i = 0; i < 30; i = i + 1) s = s + n * 4 + (n * 4) / 2; s;",
+    "s = 0; for (i = 0; i < 30; i = i + 1) for (j = 0; j < 20; j = j + 1) s = s + i * 3 + j; s;",
+    # An operand assigned in the initialization of the loop
+    "a = 2; s = 0; for (i = a = 4; i < 30; i = i + 1) s = s + a * 3; s;",
+    "a = 2; s = 0; for (a = 5; a < 30; a = a + 1) s = s + a * 3; s;",
+    # An operand of the outer loop assigned by a nested loop
+    "n = 2; s = 0; for (i = 0; i < 30; i = i + 1) { s = s + n * 4; for (j = 0; j < 3; j = j + 1) n = n + 1; } s;",
+    "n = 2; s = 0; for (i = 0; i < 30; i = i + 1) { for (j = 0; j < 3; j = j + 1) s = s + n * 4; n = n + i; } s;",
+    # An operand assigned in the condition, the body after the use, or the increment
+    "n = 31; s = 0; for (i = 0; n = n - 1; i = i + 1) s = s + n * 4; s;",
+    "n = 7; s = 0; for (i = 0; i < 30; i = i + 1) { s = s + n * 4; if (i == 10) n = 1; } s;",
+    "n = 7; s = 0; for (i = 0; i < 30; i = i + n * 0 + 1) { s = s + n * 4; } s;",
+    "n = 7; s = 0; for (i = 0; i < 30; n = n + 1) { s = s + n * 4; i = i + 1; } s;",
+    "main() { n = 3; s = 0; for (i = 0; i < 30; i = i + 1) s = s + n * n; return s; }",
+]
+
+
+@pytest.mark.parametrize("budget", [0, 128])
+@pytest.mark.parametrize("src", PROGRAMS)
+def test_hoisting_keeps_the_result(src, budget):
+    assert compile_and_run(src, unroll_budget=budget) == compile_and_run(src, optimize=False)
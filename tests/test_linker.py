@@ -0,0 +1,39 @@
+from emulator import run
+from linker import Linker, build
+
+MAIN = "inc(x) { return x + 1; } main() { return twice(5) * 100 + pick(0) * 10 + pick(1); }"
+LIB = "twice(x) { return inc(x) * 2; }"
+
+# Branches to a label of another object, once backwards and once forwards
+ZERO = "zero_case:\n   li a0, 9\n   ret\n"
+PICK = "pick:\n   beqz a0, zero_case\n   beqz zero, one_case\n"
+ONE = "one_case:\n   li a0, 7\n   ret\n"
+
+
+def _write(tmp_path) -> None:
+    for name, src in [("lib.c", LIB), ("main.c", MAIN), ("zero.s", ZERO), ("pick.s", PICK), ("one.s", ONE)]:
+        (tmp_path / name).write_text(src)
+
+
+def _link(paths: list, jobs: int = None) -> tuple[int, int]:
+    objects, rebuilt = build([str(path) for path in paths], jobs)
+    return run(Linker().link(objects)), rebuilt
+
+
+def test_units_call_each_other(tmp_path):
+    _write(tmp_path)
+
+    # main comes last but is laid out first, so that the program starts there
+    paths = [tmp_path / name for name in ["lib.c", "zero.s", "pick.s", "one.s", "main.c"]]
+    assert _link(paths) == (1200 + 90 + 7, 2)
+
+
+def test_only_edited_units_are_rebuilt(tmp_path):
+    _write(tmp_path)
+    paths = [tmp_path / name for name in ["main.c", "lib.c", "zero.s", "pick.s", "one.s"]]
+
+    assert _link(paths, 1) == (1297, 2)
+    assert _link(paths, 1) == (1297, 0)
+
+    (tmp_path / "lib.c").write_text("twice(x) { return inc(x) * 3; }")
+    assert _link(paths, 1) == (1897, 1)
@@ -0,0 +1,78 @@
+import pytest
+from emulator import run
+from tokenizer import Tokenizer
+from syntax_tree import Parser
+from compiler import Compiler
+from scheduler import Scheduler, CONTROL, default_machine
+from assembler import Assembler
+
+PROGRAMS = {
+    # Calls, recursion and arguments
+    "calls": """sq(x) { return x * x; }
+       add3(a, b, c) { return a + b + c; }
+       fib(n) { if (n < 2) return n; return fib(n - 1) + fib(n - 2); }
+       main() { s = 0; for (i = 0; i < 4; i = i + 1) s = s + sq(i); return add3(s, fib(10), 1) + add3(1, 2, 3); }""",
+    # Deep expressions with multiplications and divisions
+    "expressions": "main() { a = 7; b = 3; return ((a * b + 4) * (a - b) / 2 - (a * a) / (b + 1)) * ((a + 1) * (b + 2) - a / b); }",
+    "comparisons": "main() { a = 2; b = 9; return (a <= b) + (b <= a) * 10 + (a == 2) * 100 + (b != 9) * 1000 + (a < b) * 10000; }",
+    # Loops
+    "loops": "main() { s = 0; for (i = 0; i < 20; i = i + 1) for (j = 0; j < i; j = j + 1) s = s + i * j - j / 3; return s; }",
+    # Big constants held in the pool registers
+    "constants": """main() { a = 100000; b = -5000; d = 2147481600; s = 0;
+       for (i = 0; i < 3; i = i + 1) s = s + 100000 + 100000;
+       if (a == 100000) s = s + 1; if (b != -5000) s = s + 1000;
+       return s + (d - 2147481000) + (a == 99999); }""",
+    # A frame beyond the 12-bit offsets
+    "frame": "f(a, b) { " + " ".join(f"x{i} = a + {i};" for i in range(600)) + " return x0 * x599 + b; } main() { return f(2, 3); }",
+}
+
+
+def _records(src: str, verbose: bool = False) -> list:
+    tokenizer = Tokenizer()
+    tokenizer.tokenize(src)
+    parser = Parser(tokenizer)
+    parser.parse()
+    return Compiler(parser, optimize=False).generate_records(verbose)
+
+
+@pytest.mark.parametrize("src", PROGRAMS.values(), ids=PROGRAMS.keys())
+def test_scheduling_keeps_the_result(src):
+    scheduler = Scheduler(default_machine())
+    scheduled = scheduler.schedule_records(_records(src))
+    assert scheduler.after < scheduler.before
+    assert run(Assembler().assemble_records(scheduled).executable()) == \
+        run(Assembler().assemble_records(_records(src)).executable())
+
+
+def _blocks(records: list) -> list:
+    # Labels and control instructions stay in place, so they delimit the same blocks before and after
+    blocks = [[]]
+    for record in records:
+        blocks[-1].append(record)
+        if isinstance(record, str) and record.strip().endswith(":") or \
+                not isinstance(record, str) and record.mnemonic in CONTROL:
+            blocks.append([])
+    return blocks
+
+
+@pytest.mark.parametrize("src", PROGRAMS.values(), ids=PROGRAMS.keys())
+def test_comments_stay_with_the_original_order(src):
+    original = _blocks(_records(src, True))
+    scheduled = _blocks(Scheduler(default_machine()).schedule_records(_records(src, True)))
+    assert len(original) == len(scheduled)
+
+    def text(block):
+        return [record if isinstance(record, str) else record.text for record in block]
+
+    for before, after in zip(original, scheduled):
+        if [r.text for r in before if not isinstance(r, str)] == [r.text for r in after if not isinstance(r, str)]:
+            assert text(after) == text(before)
+            continue
+
+        # A comment may only be left in front of the label ending the block
+        comment = False
+        for record in after:
+            if not isinstance(record, str):
+                assert not comment
+            elif record.startswith("#"):
+                comment = True
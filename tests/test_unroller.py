@@ -0,0 +1,25 @@
+import pytest
+from emulator import compile_and_run
+
+# Programs whose value is whatever the last expression statement left in a0
+PROGRAMS = [
+    # The body never produces a value, so a0 must keep the one from before the loop
+    "x = 5; for (i = 0; i < 3; i = i + 1) if (0) x = 1;",
+    "x = 5; for (i = 0; i < 40; i = i + 1) if (i == 100) x = 1;",
+    "x = 5; for (i = 0; i < 3; i = i + 1) {}",
+    "x = 5; for (i = 0; i < 40; i = i + 1) {}",
+    "x = 5; for (i = 0; i < 3; i = i + 1) for (j = 0; j < 2; j = j + 1) if (0) x = 1;",
+    # Zero trips
+    "s = 7; for (i = 0; i < 0; i = i + 1) s = s + 1;",
+    # Full and partial unrolling with a value in the body
+    "s = 0; for (i = 0; i < 5; i = i + 1) s = s + i;",
+    "s = 0; for (i = 0; i < 37; i = i + 1) s = s + i * 2;",
+    "s = 0; for (i = 0; i < 37; i = i + 1) { if (i == 100) s = 1; s; }",
+    "main() { x = 5; for (i = 0; i < 3; i = i + 1) if (0) x = 1; }",
+    "main() { s = 0; for (i = 0; i < 3; i = i + 1) s = s + i; return s + i; }",
+]
+
+
+@pytest.mark.parametrize("src", PROGRAMS)
+def test_unrolled_loops_keep_the_result(src):
+    assert compile_and_run(src) == compile_and_run(src, optimize=False)
@@ -1,5 +1,4 @@
 from enum import Enum
-import sys
 from utils import *
 
 class TokenType(Enum):
@@ -19,6 +18,7 @@ class Tokenizer():
     KEYWORDS = ["return", "if", "else", "while", "for"]
     def __init__(self) -> None:
         self.tokens: list[Token] = []
+        self.pos = 0    # Index of the next token to consume
 
     @staticmethod
     def _is_keyword(s: str) -> bool:
@@ -36,19 +36,19 @@ class Tokenizer():
                 i += 2
                 continue
 
-            elif src[i] in "+-()*/<>=;{}":
+            elif src[i] in "+-()*/<>=;{},":
                 self.tokens.append(Token(TokenType.TK_RESERVED, src[i]))
                 i += 1
                 continue
 
             elif src[i].isdigit():
-                val, val_len = strtol(src[i:])
+                val, val_len = strtol(src, i)
                 self.tokens.append(Token(TokenType.TK_NUM, src[i:i+val_len], val))
                 i += val_len
                 continue
 
             elif is_valid_as_head(src[i]):
-                ident = get_ident(src[i:])
+                ident = get_ident(src, i)
                 if Tokenizer._is_keyword(ident):
                     self.tokens.append(Token(TokenType.TK_KEYWORD, ident))
                 else:
@@ -57,42 +57,40 @@ class Tokenizer():
                 continue
 
             else:
-                print(f"Failed to tokenize: {src[i:]}", file=sys.stderr)
-                sys.exit(1)
+                raise CompileError(f"Failed to tokenize: {src[i:]}")
         
         self.tokens.append(Token(TokenType.TK_EOF, ""))
     
+    def peek(self, n: int = 0) -> Token:
+        return self.tokens[min(self.pos + n, len(self.tokens) - 1)]
+
     def consume(self, op: str) -> bool:
-        if self.tokens[0].type == TokenType.TK_RESERVED or self.tokens[0].type == TokenType.TK_KEYWORD:
-            if self.tokens[0].token_str == op:
-                self.tokens.pop(0)
+        tok = self.tokens[self.pos]
+        if tok.type == TokenType.TK_RESERVED or tok.type == TokenType.TK_KEYWORD:
+            if tok.token_str == op:
+                self.pos += 1
                 return True
         return False
     
     def consume_ident(self):
-        if self.tokens[0].type != TokenType.TK_IDENT:
+        if self.tokens[self.pos].type != TokenType.TK_IDENT:
             return None
         
-        return self.tokens.pop(0)
+        self.pos += 1
+        return self.tokens[self.pos - 1]
     
     def expect(self, op: str) -> None:
-        if self.tokens[0].type != TokenType.TK_RESERVED or self.tokens[0].token_str != op:
-            print(f"Expected {op} but got {self.tokens[0].token_str}.", file=sys.stderr)
-            sys.exit(1)
-        self.tokens.pop(0)
+        tok = self.tokens[self.pos]
+        if tok.type != TokenType.TK_RESERVED or tok.token_str != op:
+            raise CompileError(f"Expected {op} but got {tok.token_str}.")
+        self.pos += 1
     
     def expect_number(self) -> int:
-        if self.tokens[0].type != TokenType.TK_NUM:
-            print(f"Expected a number but got {self.tokens[0].token_str}.", file=sys.stderr)
-            sys.exit(1)
-        val = self.tokens[0].val
-        self.tokens.pop(0)
-        return val
+        tok = self.tokens[self.pos]
+        if tok.type != TokenType.TK_NUM:
+            raise CompileError(f"Expected a number but got {tok.token_str}.")
+        self.pos += 1
+        return tok.val
     
     def at_eof(self) -> bool:
-        return self.tokens[0].type == TokenType.TK_EOF
-
-        
-        
-        
-        
+        return self.tokens[self.pos].type == TokenType.TK_EOF
@@ -0,0 +1,423 @@
+import re
+from syntax_tree import Parser, Node, NodeType, Function, walk, clone
+
+# Instructions emitted for each kind of node, not counting its children (see Compiler.generate)
+NODE_COSTS = {
+    NodeType.ND_NUM: 3,         # li, push
+    NodeType.ND_LVAR: 6,        # address, push, load
+    NodeType.ND_ASSIGN: 9,      # address, push, pop, store, push
+    NodeType.ND_RETURN: 6,      # pop to a0, epilogue
+    NodeType.ND_IF: 3,          # pop, beqz
+    NodeType.ND_FOR: 4,         # pop, beqz, j
+    NodeType.ND_BLOCK: 0,
+    NodeType.ND_FUNCALL: 4,     # jal, mv, push
+    NodeType.ND_COMMA: 1,       # discard
+}
+BINARY_COSTS = {
+    NodeType.ND_ADD: 6, NodeType.ND_SUB: 6, NodeType.ND_MUL: 6, NodeType.ND_DIV: 6,
+    NodeType.ND_EQ: 7, NodeType.ND_NEQ: 7, NodeType.ND_LT: 6, NodeType.ND_LE: 9,
+}
+STATEMENTS = (NodeType.ND_RETURN, NodeType.ND_IF, NodeType.ND_FOR, NodeType.ND_BLOCK)
+
+# Operators the trip count of a loop may be computed with
+FOLDABLE = {
+    NodeType.ND_ADD: lambda a, b: a + b,
+    NodeType.ND_SUB: lambda a, b: a - b,
+    NodeType.ND_MUL: lambda a, b: a * b,
+    NodeType.ND_EQ: lambda a, b: int(a == b),
+    NodeType.ND_NEQ: lambda a, b: int(a != b),
+    NodeType.ND_LT: lambda a, b: int(a < b),
+    NodeType.ND_LE: lambda a, b: int(a <= b),
+}
+
+
+def _node_cost(node: Node, stmt: bool) -> int:
+    # Instructions of the node itself, not counting its children
+    size = BINARY_COSTS[node.node_type] if node.node_type in BINARY_COSTS else NODE_COSTS[node.node_type]
+    if node.node_type == NodeType.ND_NUM and not -2048 <= node.val < 2048:
+        size += 1
+    if node.node_type == NodeType.ND_FUNCALL and len(node.args) > 0:
+        size += len(node.args) + 1
+    if stmt and node.node_type not in STATEMENTS:
+        size += 2
+    if node.node_type == NodeType.ND_IF and node.els:
+        size += 1
+    if node.node_type == NodeType.ND_FOR:
+        size += (node.init is not None) + (node.inc is not None)
+    return size
+
+
+def _children(node: Node) -> list[tuple[Node, bool]]:
+    # The children of the node, and whether each is compiled as a statement
+    children = [(node.lhs, False), (node.rhs, False), (node.cond, False), (node.init, False), (node.inc, False)]
+    children += [(node.then, True), (node.els, True)]
+    children += [(child, True) for child in node.block or []]
+    children += [(arg, False) for arg in node.args or []]
+    return [(child, stmt) for child, stmt in children if child is not None]
+
+
+def estimate_size(node: Node, stmt: bool = True, leave_out: set = frozenset()) -> int:
+    """ Estimate the number of instructions the compiler emits for the given tree
+
+    Args:
+        node (Node): The tree to estimate.
+        stmt (bool): Whether the tree is compiled as a statement, whose value is popped to a0.
+        leave_out (set): The ids of the subtrees not to count.
+
+    Returns:
+        int: The estimated number of instructions.
+
+    """
+
+    size = 0
+    stack = [(node, stmt)]
+    while len(stack) > 0:
+        node, stmt = stack.pop()
+        if id(node) in leave_out:
+            continue
+        size += _node_cost(node, stmt)
+        stack += _children(node)
+    return size
+
+
+def subtree_sizes(root: Node, sizes: dict, parents: dict = None, stmt: bool = True) -> None:
+    """ Estimate the instructions of every subtree of the given tree, bottom-up
+
+    Args:
+        root (Node): The tree to estimate.
+        sizes (dict): The estimates by node id, to add those of the tree to.
+        parents (dict): The parent of every node by id, to add those of the tree to, if given.
+        stmt (bool): Whether the tree is compiled as a statement.
+
+    """
+
+    stack = [(root, stmt, False)]
+    while len(stack) > 0:
+        node, stmt, visited = stack.pop()
+        children = _children(node)
+        if not visited:
+            stack.append((node, stmt, True))
+            stack += [(child, child_stmt, False) for child, child_stmt in children]
+            if parents is not None:
+                parents.update((id(child), node) for child, _ in children)
+            continue
+        sizes[id(node)] = _node_cost(node, stmt) + sum(sizes[id(child)] for child, _ in children)
+
+
+def evaluate(node: Node, env: dict):
+    """ Evaluate an expression of constants and the given variables
+
+    Returns:
+        int: The value, or None if the expression refers to anything else or leaves 32 bits.
+
+    """
+
+    values = []
+    stack = [(node, False)]
+    while len(stack) > 0:
+        node, visited = stack.pop()
+        if node.node_type == NodeType.ND_NUM:
+            values.append(node.val)
+        elif node.node_type == NodeType.ND_LVAR and node.offset in env:
+            values.append(env[node.offset])
+        elif node.node_type not in FOLDABLE:
+            return None
+        elif visited:
+            rhs = values.pop()
+            values.append(FOLDABLE[node.node_type](values.pop(), rhs))
+            if not -(1 << 31) <= values[-1] < (1 << 31):
+                return None
+        else:
+            stack += [(node, True), (node.rhs, False), (node.lhs, False)]
+    return values[0]
+
+
+class LoopSite():
+    def __init__(self, func: str, label: str, factor: int, trips: int, size: int, before: int, after: int) -> None:
+        self.func = func
+        self.label = label
+        self.factor = factor
+        self.trips = trips
+        self.size = size
+        self.before = before
+        self.after = after
+
+    def __str__(self) -> str:
+        how = f"fully ({self.trips} iterations)" if self.factor == self.trips else f"by {self.factor} ({self.trips} iterations)"
+        return f"unrolled {self.label} in {self.func} {how}: instructions {self.size:+d}, cycles {self.before} -> {self.after}"
+
+
+class Unroller():
+    """ Unroll loops under a code-size budget
+
+    A loop whose trip count is a compile-time constant is unrolled fully when it runs at
+    most max_trips times, with the induction variable replaced by its value in every copy.
+    Otherwise it is unrolled by the largest factor up to max_factor whose growth fits the
+    remaining budget, with the leftover iterations peeled in front of the loop. Loops of
+    unknown trip count are left alone: without a trip count the condition has to be tested
+    between the copies, which saves only the jump back. Inner loops are considered first,
+    so they get the budget.
+
+    Attributes:
+        parser (Parser): The parser holding the functions to transform.
+        budget (int): The number of instructions the unrolled loops may add to the program.
+        max_trips (int): The longest loop to unroll fully.
+        max_factor (int): The largest factor of partial unrolling.
+        sites (list[LoopSite]): The unrolled loops.
+        sizes (dict[int, int]): The estimated instructions of every subtree of the current function, by node id.
+        parents (dict[int, Node]): The parent of every node of the current function, by node id.
+
+    """
+
+    def __init__(self, parser: Parser, budget: int = 128, max_trips: int = 16, max_factor: int = 8) -> None:
+        self.parser = parser
+        self.budget = budget
+        self.max_trips = max_trips
+        self.max_factor = max_factor
+        self.sites: list[LoopSite] = []
+        self.sizes: dict[int, int] = {}
+        self.parents: dict[int, Node] = {}
+
+    def _copy(self, node: Node) -> Node:
+        # Every copy of a loop or an if statement needs labels of its own
+        node = clone(node)
+        for child in walk(node):
+            if child.node_type in (NodeType.ND_IF, NodeType.ND_FOR):
+                n = len(self.parser.labels)
+                child.labels = [re.sub(r"\d+$", f"{n:03}", label) for label in child.labels]
+                self.parser.labels += child.labels
+        return node
+
+    def _block(self, stmts: list[Node]) -> Node:
+        node = Node(NodeType.ND_BLOCK)
+        node.block = stmts
+        return node
+
+    @staticmethod
+    def _prepend(expr: Node, stmt: Node):
+        """ Evaluate an expression for its side effects ahead of a statement
+
+        Returns:
+            Node: The statement, or None if it has no expression to evaluate it with (an empty block).
+
+        """
+
+        parent, first = None, stmt
+        while first.node_type == NodeType.ND_BLOCK:
+            if len(first.block) == 0:
+                return None
+            parent, first = first, first.block[0]
+
+        if first.node_type == NodeType.ND_IF:
+            first.cond = Node(NodeType.ND_COMMA, expr, first.cond)
+        elif first.node_type == NodeType.ND_FOR:
+            first.init = Node(NodeType.ND_COMMA, expr, first.init) if first.init else expr
+        elif first.node_type == NodeType.ND_RETURN:
+            first.lhs = Node(NodeType.ND_COMMA, expr, first.lhs)
+        elif parent is None:
+            return Node(NodeType.ND_COMMA, expr, first)
+        else:
+            parent.block[0] = Node(NodeType.ND_COMMA, expr, first)
+        return stmt
+
+    def _sequence(self, items: list[tuple[bool, Node]]):
+        """ Build a block of statements and of expressions evaluated for their side effects only
+
+        An expression statement leaves its value in a0 (see Compiler.generate), while the
+        initialization and the increment of a loop do not. So that the unrolled loop leaves
+        a0 as the loop did, such expressions are evaluated as part of the next statement.
+
+        Args:
+            items (list[tuple[bool, Node]]): Whether each node is an expression to discard, and the node.
+
+        Returns:
+            Node: The block, or None if an expression is not followed by a statement to carry it.
+
+        """
+
+        stmts = []
+        pending = None
+        for discard, node in items:
+            if discard:
+                pending = node if pending is None else Node(NodeType.ND_COMMA, pending, node)
+                continue
+            if pending is not None:
+                carried = Unroller._prepend(pending, node)
+                if carried is not None:
+                    node, pending = carried, None
+            stmts.append(node)
+        return self._block(stmts) if pending is None else None
+
+    @staticmethod
+    def _induction(loop: Node) -> Node:
+        # LICM puts the computations it hoists out of the loop ahead of the original initialization
+        if loop.init is not None and loop.init.node_type == NodeType.ND_COMMA:
+            return loop.init.rhs
+        return loop.init
+
+    def _trip_values(self, loop: Node):
+        """ Simulate a counted loop
+
+        Returns:
+            list[int]: The values of the induction variable on entry to each iteration and on exit,
+            or None if the trip count is not a compile-time constant of at most 1 << 12.
+
+        """
+
+        init, cond, inc = Unroller._induction(loop), loop.cond, loop.inc
+        if init is None or cond is None or inc is None:
+            return None
+        if init.node_type != NodeType.ND_ASSIGN or init.lhs.node_type != NodeType.ND_LVAR:
+            return None
+        if inc.node_type != NodeType.ND_ASSIGN or inc.lhs.node_type != NodeType.ND_LVAR:
+            return None
+
+        var = init.lhs.offset
+        if inc.lhs.offset != var:
+            return None
+        if any(node.node_type == NodeType.ND_ASSIGN and node.lhs.offset == var for node in walk(loop.then)):
+            return None
+
+        values = [evaluate(init.rhs, {})]
+        while values[-1] is not None and len(values) <= 1 << 12:
+            taken = evaluate(cond, {var: values[-1]})
+            if taken is None:
+                return None
+            if not taken:
+                return values
+            values.append(evaluate(inc.rhs, {var: values[-1]}))
+        return None
+
+    def _unroll_fully(self, loop: Node, values: list[int]):
+        var = Unroller._induction(loop).lhs.offset
+        items = [(True, clone(loop.init.lhs))] if loop.init.node_type == NodeType.ND_COMMA else []
+        for value in values[:-1]:
+            body = self._copy(loop.then)
+            for node in [node for node in walk(body) if node.node_type == NodeType.ND_LVAR and node.offset == var]:
+                node.__dict__.update(Node(NodeType.ND_NUM, val=value).__dict__)
+            items.append((False, body))
+
+        # The induction variable keeps its final value
+        last = Node(NodeType.ND_ASSIGN, clone(Unroller._induction(loop).lhs), Node(NodeType.ND_NUM, val=values[-1]))
+        items.insert(len(items) - 1, (True, last))
+        return self._sequence(items)
+
+    def _unroll_counted(self, loop: Node, trips: int, factor: int):
+        items = [(True, clone(loop.init))]
+        for _ in range(trips % factor):
+            items += [(False, self._copy(loop.then)), (True, clone(loop.inc))]
+
+        body = []
+        for i in range(factor):
+            body.append((False, self._copy(loop.then)))
+            if i < factor - 1:
+                body.append((True, clone(loop.inc)))
+        body = self._sequence(body)
+        if body is None:
+            return None
+
+        node = Node(NodeType.ND_FOR, cond=clone(loop.cond), then=body, labels=loop.labels, inc=clone(loop.inc))
+        return self._sequence(items + [(False, node)])
+
+    def _unroll(self, func: Function, loop: Node):
+        """ Pick the factor of the given loop and build its unrolled form
+
+        Returns:
+            tuple[Node, LoopSite]: The unrolled loop and its report, or None if unrolling does not pay off.
+
+        """
+
+        # Loops that shrink do not add to the budget, or they would pay for copying their parents
+        remaining = min(self.budget, self.budget - sum(site.size for site in self.sites))
+
+        # Every node of a copy takes at least one instruction, so a body larger than the
+        # remaining budget cannot be copied. Counting stops there, so that no loop costs
+        # more than the budget to look at, however deeply it is nested.
+        for i, _ in enumerate(walk(loop.then)):
+            if i >= remaining:
+                return None
+
+        values = self._trip_values(loop)
+        if values is None:
+            return None
+
+        # A loop that never runs is left alone, its initialization is all there is to it
+        trips = len(values) - 1
+        if trips == 0:
+            return None
+
+        size = self.sizes[id(loop)]
+        body = self.sizes[id(loop.then)]
+        check = self.sizes[id(loop.cond)] + 3
+        inc = self.sizes[id(loop.inc)]
+        init = self.sizes[id(loop.init)]
+        before = init + 1 + trips * (check + body + inc + 2) + check
+
+        if trips <= self.max_trips:
+            node = self._unroll_fully(loop, values)
+            growth = estimate_size(node) - size if node else None
+            if node and growth <= remaining:
+                return node, LoopSite(func.name, loop.labels[0], trips, trips, growth, before, estimate_size(node))
+
+        # The copies but the last one pay for discarding the increment instead of the jump back
+        for factor in range(min(self.max_factor, trips), 1, -1):
+            node = self._unroll_counted(loop, trips, factor)
+            if node is None:
+                return None
+            growth = estimate_size(node) - size
+            after = (init + 1 + (trips % factor) * (body + inc + 1)
+                     + (trips // factor) * (check + factor * body + (factor - 1) * (inc + 1) + inc + 2) + check)
+            if growth <= remaining and after < before:
+                return node, LoopSite(func.name, loop.labels[0], factor, trips, growth, before, after)
+        return None
+
+    def run(self) -> list[str]:
+        """ Unroll the loops of every function
+
+        Returns:
+            list[str]: The report of the unrolled loops.
+
+        """
+
+        for func in self.parser.functions:
+            self.sizes = {}
+            self.parents = {}
+            for stmt in func.code:
+                subtree_sizes(stmt, self.sizes, self.parents)
+
+            loops = []
+            stack = [(stmt, 0) for stmt in reversed(func.code)]
+            while len(stack) > 0:
+                node, depth = stack.pop()
+                if node is None:
+                    continue
+                if node.node_type == NodeType.ND_FOR:
+                    loops.append((depth, node))
+                    depth += 1
+                stack += [(child, depth) for child in reversed(node.block or [])]
+                stack += [(node.els, depth), (node.then, depth)]
+
+            # The innermost loops run most often, so they go first, and otherwise in the order of the source
+            loops.sort(key=lambda loop: -loop[0])
+            for _, loop in loops:
+                unrolled = self._unroll(func, loop)
+                if unrolled is None:
+                    continue
+                node, site = unrolled
+                loop.__dict__.update(node.__dict__)
+                self.sites.append(site)
+
+                # Only the new subtree is estimated, the enclosing ones change by the growth
+                subtree_sizes(loop, self.sizes)
+                parent = self.parents.get(id(loop))
+                while parent is not None:
+                    self.sizes[id(parent)] += site.size
+                    parent = self.parents.get(id(parent))
+
+        if len(self.sites) == 0:
+            return []
+
+        report = [str(site) for site in self.sites]
+        report.append(f"unrolling: {len(self.sites)} loops, instructions {sum(site.size for site in self.sites):+d} "
+                      f"(budget {self.budget})")
+        return report